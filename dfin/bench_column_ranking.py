@@ -0,0 +1,122 @@
+import ast
+import os
+import time
+from typing import Dict, List
+
+import click
+import numpy as np
+import pandas as pd
+
+from consts import PREPROCESSING_DEV_DB_EMBEDDINGS_PATH
+from utils.column_ranker import ColumnRanker
+from utils.embeddings_store import ColumnEmbeddingsStore, load_embeddings_store
+from utils.ivf_index import ann_recall
+
+
+def legacy_top_k_columns(df: pd.DataFrame, question_embedding: List[float], table_name: str, top_k: int) -> List[str]:
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    # Row-wise scoring as done by get_top_k_columns before the ranking engine
+    df = df[df['table_name'] == table_name].copy()
+    df['similarity'] = df.apply(lambda row: cosine_similarity([question_embedding], [row['embedding']])[0][0], axis=1)
+    return df.nlargest(top_k, 'similarity')['original_column_name'].tolist()
+
+
+def legacy_rank(df: pd.DataFrame, question_embedding: List[float], table_names: List[str], top_k: int
+                ) -> Dict[str, List[str]]:
+    return {table_name: legacy_top_k_columns(df, question_embedding, table_name, top_k) for table_name in table_names}
+
+
+def synthetic_wide_store(store: ColumnEmbeddingsStore, n_columns: int, n_tables: int, seed: int = 0
+                         ) -> ColumnEmbeddingsStore:
+    # Perturbed copies of the real column vectors, spread over n_tables tables
+    rng = np.random.default_rng(seed)
+    base = np.asarray(store.matrix, dtype=np.float32)
+    picks = rng.integers(len(base), size=n_columns)
+    matrix = base[picks] + rng.normal(scale=0.01, size=(n_columns, base.shape[1])).astype(np.float32)
+    return ColumnEmbeddingsStore(
+        matrix=matrix,
+        table_names=[f"table_{i % n_tables}" for i in range(n_columns)],
+        column_names=[f"{store.column_names[pick]}_{i}" for i, pick in enumerate(picks)],
+    )
+
+
+def report_ann(store: ColumnEmbeddingsStore, question_embeddings: List[List[float]], top_k: int, n_probe: int,
+               repeat: int, n_linked_tables: int = 3):
+    ranker = ColumnRanker(store)
+    build_start = time.perf_counter()
+    index = ranker.build_ann_index()
+    build_seconds = time.perf_counter() - build_start
+
+    table_names = sorted(ranker.table_rows)
+    rng = np.random.default_rng(1)
+    linked_tables = [
+        list(rng.choice(table_names, size=min(n_linked_tables, len(table_names)), replace=False))
+        for _ in question_embeddings
+    ]
+    exact = [ranker.rank(q, tables, top_k) for q, tables in zip(question_embeddings, linked_tables)]
+    ann = [ranker.rank_ann(q, tables, top_k, n_probe) for q, tables in zip(question_embeddings, linked_tables)]
+
+    exact_seconds = timed(lambda: [ranker.rank(q, t, top_k) for q, t in zip(question_embeddings, linked_tables)], repeat)
+    ann_seconds = timed(lambda: [ranker.rank_ann(q, t, top_k, n_probe) for q, t in zip(question_embeddings, linked_tables)], repeat)
+
+    questions = len(question_embeddings)
+    print(f"ANN: {len(store.column_names)} columns, {index.n_lists} lists (built in {build_seconds:.2f}s), n_probe={n_probe}")
+    print(f"Exact search: {exact_seconds / questions * 1000:.3f} ms per question")
+    print(f"ANN search:   {ann_seconds / questions * 1000:.3f} ms per question")
+    print(f"ANN recall@{top_k} against exact search: {ann_recall(exact, ann):.3f}")
+
+
+def timed(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+@click.command()
+@click.option('--db-id', default='california_schools', show_default=True, help='Database to benchmark')
+@click.option('--embeddings-dir', default=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH, show_default=True)
+@click.option('--top-k', default=15, show_default=True, type=int)
+@click.option('--questions', default=20, show_default=True, type=int, help='Number of random question vectors')
+@click.option('--repeat', default=3, show_default=True, type=int)
+@click.option('--ann-n-probe', type=int, help='Also report ANN latency and recall with this many probed lists')
+@click.option('--synthetic-columns', type=int, help='Run the ANN report on a synthetic schema this wide')
+@click.option('--synthetic-tables', default=200, show_default=True, type=int)
+def main(db_id, embeddings_dir, top_k, questions, repeat, ann_n_probe, synthetic_columns, synthetic_tables):
+    store = load_embeddings_store(embeddings_dir, db_id)
+    table_names = sorted(set(store.table_names))
+
+    # The legacy path keeps the parsed float64 python lists of the CSV shard
+    df = pd.read_csv(os.path.join(embeddings_dir, f"{db_id}.csv"))
+    df['embedding'] = df['embedding'].apply(ast.literal_eval)
+    ranker = ColumnRanker(store)
+
+    # Random questions near the column vectors, so the rankings are not degenerate
+    rng = np.random.default_rng(0)
+    base = np.asarray(store.matrix, dtype=np.float64)
+    question_embeddings = [
+        (base[rng.integers(len(base))] + rng.normal(scale=0.01, size=base.shape[1])).tolist()
+        for _ in range(questions)
+    ]
+
+    mismatches = sum(
+        legacy_rank(df, q, table_names, top_k) != ranker.rank(q, table_names, top_k) for q in question_embeddings
+    )
+
+    legacy_seconds = timed(lambda: [legacy_rank(df, q, table_names, top_k) for q in question_embeddings], repeat)
+    ranker_seconds = timed(lambda: [ranker.rank(q, table_names, top_k) for q in question_embeddings], repeat)
+
+    print(f"Database: {db_id} ({len(store.column_names)} columns, {len(table_names)} tables, top_k={top_k})")
+    print(f"Legacy row-wise cosine: {legacy_seconds / questions * 1000:.2f} ms per question")
+    print(f"Vectorized ranker:      {ranker_seconds / questions * 1000:.3f} ms per question")
+    print(f"Speedup: {legacy_seconds / ranker_seconds:.0f}x, mismatching top-k lists: {mismatches}/{questions}")
+
+    if ann_n_probe:
+        if synthetic_columns:
+            store = synthetic_wide_store(store, synthetic_columns, synthetic_tables)
+        report_ann(store, question_embeddings, top_k, ann_n_probe, repeat)
+
+
+if __name__ == '__main__':
+    main()
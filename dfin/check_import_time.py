@@ -0,0 +1,71 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import click
+
+
+# Import time budgets in milliseconds, measured in a fresh interpreter
+IMPORT_BUDGETS_MS = {
+    "consts": 20,
+    "utils.tokens": 20,
+    "utils.parsing_utils": 30,
+    "utils.usage_metrics": 120,
+    "utils.retry_policy": 50,
+    "utils.streaming_sql": 120,
+    "utils.completion_cache": 60,
+    "report_llm_usage": 250,
+    "materialize_predictions": 150,
+    "utils.azure_openai": 400,
+    "link_schema_tables": 400,
+    "link_columns": 300,
+    "dfin_sql": 600,
+}
+# Modules loaded on first use only, no import above may pull them in
+HEAVY_MODULES = ["pandas", "langchain", "sklearn", "azure.identity", "openai", "sqlglot"]
+
+PROBE = """
+import json, sys, time
+started_at = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started_at
+print(json.dumps({{"ms": elapsed * 1000, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module: str, cwd: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(cwd), cwd]))}
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                            cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(f"import {module} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option('--repeat', default=5, show_default=True, type=int, help='Fresh interpreters per module, the median counts')
+@click.option('--module', 'modules', multiple=True, help='Only check these modules, with their budget if any')
+@click.option('--slack', default=1.0, show_default=True, type=float, help='Multiplier of the budgets, for slow machines')
+def main(repeat, modules, slack):
+    """Checks that importing the dfin modules stays within its time budget and loads no heavy dependency."""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    failures = 0
+    for module in modules or IMPORT_BUDGETS_MS:
+        runs = [measure_import(module, cwd) for _ in range(repeat)]
+        median_ms = statistics.median(run["ms"] for run in runs)
+        budget_ms = IMPORT_BUDGETS_MS.get(module)
+        heavy = sorted({name for run in runs for name in run["heavy"]})
+        over = budget_ms is not None and median_ms > budget_ms * slack
+        status = "FAIL" if over or heavy else "ok"
+        failures += status == "FAIL"
+        budget = f"{budget_ms * slack:.0f} ms" if budget_ms is not None else "-"
+        print(f"{status:<5}{module:<28}{median_ms:>8.1f} ms  budget {budget:<8}"
+              + (f"  loads {', '.join(heavy)}" if heavy else ""))
+    if failures:
+        raise SystemExit(f"{failures} module(s) over budget or loading heavy dependencies at import")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,9 @@ BIRD_DEV_SUBSET_JSON = f"{DB_PREPROCESSING_DIR}/dev_subset.json"
 
 # Output
 OUTPUT_PREDICT_JSON = "output/predict_dev.json"
+PREDICTIONS_JOURNAL_PATH = "output/predict_dev.jsonl"
 LOGS_PATH = "output/logs.csv"
+RUN_LOG_PATH = "output/logs.jsonl"
 LINKED_TABLES_DIR = "output/linked_tables"
 LINKED_COLUMNS_DIR = "output/linked_columns"
 QUESTION_EMBEDDINGS_PATH = "output/question_embeddings.json"
@@ -27,4 +29,13 @@ LINK_TABLE_MODES = [
     MINIMAL,
     BALANCED,
     CONSERVATIVE
-]
\ No newline at end of file
+]
+
+# Column retrieval
+EXACT_COLUMN_SEARCH = "exact"
+ANN_COLUMN_SEARCH = "ann"
+
+COLUMN_SEARCH_MODES = [
+    EXACT_COLUMN_SEARCH,
+    ANN_COLUMN_SEARCH
+]
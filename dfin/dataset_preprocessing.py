@@ -2,11 +2,16 @@ import os
 import glob
 import json
 import re
-import pandas as pd
-from langchain.utilities.sql_database import SQLDatabase
+import numpy as np
 
 from dfin.consts import *
-from dfin.utils.azure_openai import get_completion_4, get_embedding
+from dfin.utils.azure_openai import get_completion_4, get_embeddings, status_reporter
+from dfin.utils.disk_cache import hash_key
+from dfin.utils.usage_metrics import llm_stage, USAGE_METRICS
+from dfin.utils.embeddings_store import write_embeddings_store, load_embeddings_store, \
+    convert_csv_to_embeddings_store, get_store_paths, load_manifest, write_manifest, FLOAT32, INDEX_SUFFIX
+from dfin.utils.column_ranker import ColumnRanker
+from dfin.utils.ivf_index import get_ivf_index_path
 
 
 def table_description_parser(database_dir, table_name):
@@ -20,6 +25,8 @@ def table_description_parser(database_dir, table_name):
     Returns:
     - str: Description of the table.
     """
+    import pandas as pd
+
     file_path = os.path.join(database_dir, f"{table_name}.csv")
     if not os.path.exists(file_path):
         return f"No CSV found for table: {table_name}"
@@ -59,6 +66,8 @@ def get_table_names(database_dir):
 
 
 def get_table_create_statement_with_sample(db_uri, table_name):
+    from langchain.utilities.sql_database import SQLDatabase
+
     db = SQLDatabase.from_uri("sqlite:///"+db_uri)
     db._sample_rows_in_table_info = 0
     return db.get_table_info_no_throw([table_name])
@@ -151,23 +160,27 @@ def generate_general_table_descriptions(db_path: str = "dev/dev_databases"):
     data = []
 
     databases = sorted(glob.glob(f"{db_path}/*"))
-    for db in databases:
-        db_name = os.path.basename(db)
-        db_uri = f"{db_path}/{db_name}/{db_name}.sqlite"
-        db_descriptions_path = f"{db}/database_description"
-        tables = get_table_names(db_descriptions_path)
-        print(db_descriptions_path)
-
-        for table in tables:
-            create_statement = get_table_create_statement_with_sample(db_uri, table)
-            annotated_columns_description = table_description_parser(db_descriptions_path, table)
-            table_description = get_table_comprehensive_description(db_name, table, create_statement, annotated_columns_description)
+    with status_reporter():
+        for db in databases:
+            db_name = os.path.basename(db)
+            db_uri = f"{db_path}/{db_name}/{db_name}.sqlite"
+            db_descriptions_path = f"{db}/database_description"
+            tables = get_table_names(db_descriptions_path)
+            print(db_descriptions_path)
+
+            for table in tables:
+                create_statement = get_table_create_statement_with_sample(db_uri, table)
+                annotated_columns_description = table_description_parser(db_descriptions_path, table)
+                with llm_stage("table_description", db_name):
+                    table_description = get_table_comprehensive_description(db_name, table, create_statement, annotated_columns_description)
 
-            data.append({
-                'db_name': db_name,
-                'table_name': table,
-                'description': table_description,
-            })
+                data.append({
+                    'db_name': db_name,
+                    'table_name': table,
+                    'description': table_description,
+                })
+
+    print(USAGE_METRICS.format_report())
 
     with open('../db_preprocessing/tables_description.json', 'w') as f:
         json.dump(data, f, indent=4)
@@ -178,78 +191,192 @@ def generate_general_table_descriptions(db_path: str = "dev/dev_databases"):
     print(loaded_data[:2])
 
 
-def create_dataset_columns_description_embeddings(input_dir=BIRD_DEV_DATABASES_PATH,
-                                                  output_dir=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH):
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+def read_database_column_descriptions(db_path):
+    """
+    Builds the text to embed for every column of a database from its BIRD description CSV files.
 
-    # Iterate through each database directory
-    for db_name in os.listdir(input_dir):
-        db_path = os.path.join(input_dir, db_name, "database_description")
+    Args:
+    - db_path (str): Path to the `database_description` directory of the database.
 
-        # Skip if it's not a directory
-        if not os.path.isdir(db_path):
-            continue
+    Returns:
+    - List[Dict]: Items with 'table_name', 'original_column_name' and 'description' keys.
+    """
+    import pandas as pd
 
-        # List to store the data for this database
-        data = []
+    data = []
 
-        # Iterate through each metadata CSV file
-        for table_name in os.listdir(db_path):
-            table_path = os.path.join(db_path, table_name)
+    # Iterate through each metadata CSV file
+    for table_name in sorted(os.listdir(db_path)):
+        table_path = os.path.join(db_path, table_name)
 
-            # Skip if it's not a CSV file
-            if not table_path.endswith('.csv'):
-                continue
+        # Skip if it's not a CSV file
+        if not table_path.endswith('.csv'):
+            continue
 
-            # Try reading the CSV file with different encodings
+        # Try reading the CSV file with different encodings
+        try:
+            df = pd.read_csv(table_path)
+        except UnicodeDecodeError:
             try:
-                df = pd.read_csv(table_path)
-            except UnicodeDecodeError:
-                try:
-                    df = pd.read_csv(table_path, encoding='ISO-8859-1')
-                except Exception as e:
-                    print(f"Error reading {table_path} with ISO-8859-1 encoding: {e}")
-                    continue
+                df = pd.read_csv(table_path, encoding='ISO-8859-1')
             except Exception as e:
-                print(f"Error reading {table_path}: {e}")
+                print(f"Error reading {table_path} with ISO-8859-1 encoding: {e}")
+                continue
+        except Exception as e:
+            print(f"Error reading {table_path}: {e}")
+            continue
+
+        # Check if required columns exist
+        required_columns = ['original_column_name']
+        if not all(column in df.columns for column in required_columns):
+            print(f"One or more required columns not found in {table_path}")
+            continue
+
+        # Process each row to build the description
+        for _, row in df.iterrows():
+            original_column_name = str(row['original_column_name']).strip()
+
+            description = f"<{original_column_name}>"
+            if pd.notnull(row['column_name']) and row['column_name'] != original_column_name:
+                description += f" ({row['column_name']})"
+
+            if pd.notnull(row['column_description']):
+                description += f"\tdescription: {row['column_description']}"
+
+            if pd.notnull(row['value_description']):
+                description += f"\tvalue description: {row['value_description']}"
+
+            data.append({
+                "table_name": table_name.replace('.csv', ''),
+                "original_column_name": original_column_name,
+                "description": description,
+            })
+    return data
+
+
+def update_database_embeddings(output_dir, db_name, columns, incremental=True, precision=FLOAT32):
+    """
+    Embeds the column descriptions of a database and rewrites its embeddings shard and manifest.
+
+    In incremental mode only added or changed descriptions (by hash, against the manifest) are embedded,
+    removed columns are dropped, and an unchanged database is not rewritten at all.
+
+    Returns:
+    - bool: Whether the shard was rewritten.
+    """
+    keys = [(column["table_name"], column["original_column_name"]) for column in columns]
+    hashes = {key: hash_key(column["description"]) for key, column in zip(keys, columns)}
+
+    previous_vectors = {}
+    previous_matrix = None
+    precision_changed = False
+    manifest = {}
+    if incremental:
+        manifest = load_manifest(output_dir, db_name)
+        try:
+            store = load_embeddings_store(output_dir, db_name)
+            previous_vectors = {key: row for row, key in enumerate(zip(store.table_names, store.column_names))}
+            previous_matrix = store.dequantized_matrix()
+            precision_changed = store.matrix.size and store.matrix.dtype != np.dtype(precision)
+        except FileNotFoundError:
+            pass
+
+    to_embed = {key: column["description"] for key, column in zip(keys, columns)
+                if key not in previous_vectors or manifest.get(key) != hashes[key]}
+    removed = set(previous_vectors) - set(keys)
+    if incremental and not to_embed and not removed and not precision_changed \
+            and len(previous_vectors) == len(set(keys)):
+        return False
+
+    if incremental:
+        print(f"{db_name}: {len(to_embed)} columns to embed, {len(removed)} removed")
+
+    # Embed in batches, through the embeddings cache
+    embeddings = dict(zip(to_embed, get_embeddings(list(to_embed.values()))))
+
+    data = []
+    for table_name, original_column_name in keys:
+        key = (table_name, original_column_name)
+        data.append({
+            "table_name": table_name,
+            "original_column_name": original_column_name,
+            # Unchanged columns keep their previous vector
+            "embedding": embeddings[key] if key in embeddings else previous_matrix[previous_vectors[key]],
+        })
+
+    # Save the embeddings as a float32 matrix and a table/column index
+    write_embeddings_store(output_dir, db_name, data, precision)
+    write_manifest(output_dir, db_name, hashes)
+    return True
+
+
+def create_dataset_columns_description_embeddings(input_dir=BIRD_DEV_DATABASES_PATH,
+                                                  output_dir=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH,
+                                                  build_ann_index=False,
+                                                  incremental=False,
+                                                  precision=FLOAT32):
+    # Ensure the output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    with status_reporter():
+        # Iterate through each database directory
+        for db_name in os.listdir(input_dir):
+            db_path = os.path.join(input_dir, db_name, "database_description")
+
+            # Skip if it's not a directory
+            if not os.path.isdir(db_path):
                 continue
 
-            # Check if required columns exist
-            required_columns = ['original_column_name']
-            if not all(column in df.columns for column in required_columns):
-                print(f"One or more required columns not found in {table_path}")
+            columns = read_database_column_descriptions(db_path)
+            with llm_stage("embedding", db_name):
+                updated = update_database_embeddings(output_dir, db_name, columns, incremental, precision)
+            if not updated:
+                print(f"Column descriptions of {db_name} are unchanged, skipping")
+                if build_ann_index and not os.path.exists(get_ivf_index_path(output_dir, db_name)):
+                    build_column_ann_index(output_dir, db_name)
                 continue
 
-            # Process each row to generate embeddings
-            for _, row in df.iterrows():
-                original_column_name = str(row['original_column_name']).strip()
+            output_file_path, _ = get_store_paths(output_dir, db_name)
+            print(f"Column descriptions with embeddings for {db_name} saved to {output_file_path}")
 
-                description = f"<{original_column_name}>"
-                if pd.notnull(row['column_name']) and row['column_name'] != original_column_name:
-                    description += f" ({row['column_name']})"
+            if build_ann_index:
+                build_column_ann_index(output_dir, db_name)
 
-                if pd.notnull(row['column_description']):
-                    description += f"\tdescription: {row['column_description']}"
+    print(USAGE_METRICS.format_report())
 
-                if pd.notnull(row['value_description']):
-                    description += f"\tvalue description: {row['value_description']}"
 
-                # Get the embedding
-                embedding = get_embedding(description) if get_embedding else None
+def build_column_ann_index(embeddings_dir, db_name, n_lists=None):
+    """
+    Builds the IVF index used by approximate column search and saves it next to the database embeddings.
 
-                # Add to the data list
-                data.append({
-                    "table_name": table_name.replace('.csv', ''),
-                    "original_column_name": original_column_name,
-                    "embedding": embedding,
-                })
+    Args:
+    - embeddings_dir (str): Directory containing the embeddings store of the database.
+    - db_name (str): Name of the database.
+    - n_lists (int): Number of inverted lists, defaults to ~2 * sqrt(number of columns).
+    """
+    ranker = ColumnRanker.load(embeddings_dir, db_name)
+    index = ranker.build_ann_index(n_lists)
+    index_path = get_ivf_index_path(embeddings_dir, db_name)
+    index.save(index_path)
+    print(f"ANN index with {index.n_lists} lists for {db_name} saved to {index_path}")
 
-        # Create a DataFrame from the data and save to a CSV file
-        output_df = pd.DataFrame(data)
-        output_file_path = os.path.join(output_dir, f"{db_name}.csv")
-        output_df.to_csv(output_file_path, index=False)
-        print(f"Column descriptions with embeddings for {db_name} saved to {output_file_path}")
+
+def build_column_ann_indexes(embeddings_dir=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH, n_lists=None):
+    # One index file per database, whatever its matrix and scales files are named
+    for index_path in sorted(glob.glob(f"{embeddings_dir}/*{INDEX_SUFFIX}")):
+        build_column_ann_index(embeddings_dir, os.path.basename(index_path)[:-len(INDEX_SUFFIX)], n_lists)
+
+
+def convert_csv_embeddings_to_store(embeddings_dir=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH):
+    """
+    Converts every legacy `{db_name}.csv` embeddings file in the directory to the binary store.
+
+    Args:
+    - embeddings_dir (str): Directory containing the CSV files written by earlier runs.
+    """
+    for csv_path in sorted(glob.glob(f"{embeddings_dir}/*.csv")):
+        output_file_path = convert_csv_to_embeddings_store(csv_path)
+        print(f"Converted {csv_path} to {output_file_path}")
 
 
 def create_subset_of_dataset(input_dataset_path: str = "dev/dev.json", output_dataset_path: str = "dev/dev_subset.json"):
@@ -280,6 +407,8 @@ def create_subset_of_dataset(input_dataset_path: str = "dev/dev.json", output_da
 
 
 def validate_embeddings(input_dir=BIRD_DEV_DATABASES_PATH, embeddings_dir=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH):
+    import pandas as pd
+
     for db_name in os.listdir(input_dir):
         db_path = os.path.join(input_dir, db_name, "database_description")
 
@@ -316,19 +445,16 @@ def validate_embeddings(input_dir=BIRD_DEV_DATABASES_PATH, embeddings_dir=PREPRO
             bird_data[cleaned_table_name] = set(name.strip() for name in df['original_column_name'])
 
 
-        # Load the generated embeddings CSV file
-        embeddings_file_path = os.path.join(embeddings_dir, f"{db_name}.csv")
+        # Load the generated embeddings store
         try:
-            embeddings_df = pd.read_csv(embeddings_file_path)
+            store = load_embeddings_store(embeddings_dir, db_name)
         except Exception as e:
-            print(f"Error reading {embeddings_file_path}: {e}")
+            print(f"Error reading embeddings of {db_name} from {embeddings_dir}: {e}")
             continue
 
-        # Convert the embeddings data to a dictionary for faster lookup
+        # Convert the embeddings index to a dictionary for faster lookup
         embeddings_data = {}
-        for _, row in embeddings_df.iterrows():
-            table_name = row['table_name']
-            original_column_name = row['original_column_name']
+        for table_name, original_column_name in zip(store.table_names, store.column_names):
             if table_name not in embeddings_data:
                 embeddings_data[table_name] = set()
             embeddings_data[table_name].add(original_column_name)
@@ -346,15 +472,15 @@ def validate_embeddings(input_dir=BIRD_DEV_DATABASES_PATH, embeddings_dir=PREPRO
                             f"Missing original column name {stripped_original_column_name} in table {table_name} for {db_name}")
 
 
-# Example usage:
-create_dataset_columns_description_embeddings('../dev/dev_databases', '../db_preprocessing/column_description_embeddings')
-# validate_embeddings('../dev/dev_databases', '../db_preprocessing/column_description_embeddings')
-
-
 if __name__ == "__main__":
     pass
+    # create_dataset_columns_description_embeddings('../dev/dev_databases', '../db_preprocessing/column_description_embeddings')
+    # validate_embeddings('../dev/dev_databases', '../db_preprocessing/column_description_embeddings')
     # x = table_description_parser('dev/dev_databases/card_games/database_description', 'cards')
     # print(x)
     # create_dataset_columns_description_embeddings()
+    # create_dataset_columns_description_embeddings(incremental=True)
+    # convert_csv_embeddings_to_store()
+    # build_column_ann_indexes()
     # generate_general_table_descriptions()
     # create_subset_of_dataset()
@@ -1,39 +1,62 @@
-from typing import List, Dict
-import datetime
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
-import pandas as pd
-import json
-
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+import click
 
 from consts import *
-from utils.azure_openai import get_embedding, get_langchain_llm_4_32_k, get_langchain_llm_4
+from utils.azure_openai import get_langchain_llm_4
 from original_din_sql_utils.din_sql_original_prompts import SYSTEM_SCHEMA_LINKING_TEMPLATE, HUMAN_SCHEMA_LINKING_TEMPLATE, \
     SYSTEM_CLASSIFICATION_TEMPLATE, HUMAN_CLASSIFICATION_TEMPLATE, SYSTEM_EASY_CLASS_TEMPLATE, \
     HUMAN_EASY_CLASS_TEMPLATE, SYSTEM_NON_NESTED_CLASS_TEMPLATE, HUMAN_NON_NESTED_CLASS_TEMPLATE, \
     SYSTEM_NESTED_CLASS_TEMPLATE, HUMAN_NESTED_CLASS_TEMPLATE, SYSTEM_SELF_CORRECTION_PROMPT, \
     HUMAN_SELF_CORRECTION_PROMPT
 from original_din_sql_utils.din_sql_original_utils import extract_schema_links, extract_label_and_sub_questions, extract_sql_query, \
-    extract_revised_sql_query, update_json_file
-from link_columns import link_schema_and_get_focused_context, get_focused_schema_context_for_links
-from link_schema_tables import predict_linked_tables
+    extract_revised_sql_query
+from link_columns import get_focused_schema_context_for_links
+from utils.column_ranker_cache import COLUMN_RANKER_CACHE
+from utils.http_sessions import HTTP_TIMINGS
+from utils.retry_policy import RETRY_STATS
+from utils.usage_metrics import llm_stage, USAGE_METRICS
+from utils.azure_openai import format_rate_limiter_stats, status_reporter
+from utils.streaming_sql import SQL_MARKER, REVISED_SQL_MARKER, STREAMING_STATS
+from utils.completion_cache import COMPLETION_CACHE, enable_langchain_completion_cache, prompt_templates_version
+from utils.concurrent_runner import map_ordered, DEFAULT_CONCURRENCY
+from utils.run_log import RunLog, read_run_log, compact_run_log, parquet_engine_available, COMPACT_FORMATS, CSV, PARQUET
+from utils.prediction_journal import PredictionJournal
+from utils.links_store import ColumnLinksStore, column_links_file, open_column_links_store
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from langchain.prompts import ChatPromptTemplate
+
+
+# Importing this module has no side effects: the LLMs, the dataset and the links are loaded on first use
+
+@lru_cache(maxsize=None)
+def get_chat_models():
+    """
+    The chat LLM and its SQL streaming variants (streamed with DFIN_STREAM_SQL=1, reading stops once the SQL
+    statement is complete). Built once, the shared token provider keeps the AAD token fresh.
+    """
+    from utils.langchain_llm import with_sql_streaming
 
+    chat = get_langchain_llm_4()
+    return chat, with_sql_streaming(chat, SQL_MARKER), with_sql_streaming(chat, REVISED_SQL_MARKER)
 
-CHAT = get_langchain_llm_4()
-# Store the current time as the last reset time
-last_reset_time = datetime.datetime.now()
-dev_df = pd.read_json(BIRD_DEV_JSON_PATH)
 
-# ----------------------- #
+def load_dev_df():
+    import pandas as pd
 
-with open(f'{LINKED_COLUMNS_DIR}/column_links_results_minimal_top_k_15.json', 'r') as f:
-    preprocessed_linked_columns = json.load(f)
+    return pd.read_json(BIRD_DEV_JSON_PATH)
+
+
+# Preprocessed column links used for the focused schemas, selected with --links-file or --links-mode/--links-top-k
+column_links_path = column_links_file(LINKED_COLUMNS_DIR, MINIMAL, 15)
+
+
+def get_preprocessed_linked_columns() -> ColumnLinksStore:
+    return open_column_links_store(column_links_path)
 
 
 def get_dfin_focused_schema_context(
@@ -41,154 +64,267 @@ def get_dfin_focused_schema_context(
         db_uri: str,
         question_id: int,
 ):
-    existing_entry = next((entry for entry in preprocessed_linked_columns if entry["question_id"] == question_id), None)
+    column_links = get_preprocessed_linked_columns().column_links(question_id)
 
-    if existing_entry:
+    if column_links is not None:
         return get_focused_schema_context_for_links(
             annotated_db_descriptions_path=annotated_db_descriptions_path,
             db_uri=db_uri,
-            table_columns_dict=existing_entry["column_links"]
+            table_columns_dict=column_links
         )
     raise Exception("Missing question id in preprocessed links")
 
 
-start_index = 0
+@lru_cache(maxsize=None)
+def build_prompts() -> Dict[str, "ChatPromptTemplate"]:
+    from langchain.prompts import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
 
+    def chat_prompt(system_template: str, human_template: str) -> ChatPromptTemplate:
+        return ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(system_template),
+            HumanMessagePromptTemplate.from_template(human_template),
+        ])
 
-if __name__ == "__main__":
-    logs_df = pd.DataFrame(
-        columns=["question","gold_query","db_id","final_query","schema_linking","classification","sql_generation","self_correction"])
-
-    system_schema_linking_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_SCHEMA_LINKING_TEMPLATE)  # noqa: E501
-    human_schema_linking_prompt = HumanMessagePromptTemplate.from_template(HUMAN_SCHEMA_LINKING_TEMPLATE) # noqa: E501
-    schema_linking_prompt = ChatPromptTemplate.from_messages([system_schema_linking_prompt, human_schema_linking_prompt]) # noqa: E501
-    system_classification_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_CLASSIFICATION_TEMPLATE) # noqa: E501
-    human_classification_prompt = HumanMessagePromptTemplate.from_template(HUMAN_CLASSIFICATION_TEMPLATE) # noqa: E501
-    classification_prompt = ChatPromptTemplate.from_messages([system_classification_prompt, human_classification_prompt]) # noqa: E501
-    system_easy_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_EASY_CLASS_TEMPLATE) # noqa: E501
-    human_easy_prompt = HumanMessagePromptTemplate.from_template(HUMAN_EASY_CLASS_TEMPLATE) # noqa: E501
-    easy_prompt = ChatPromptTemplate.from_messages([system_easy_prompt, human_easy_prompt]) # noqa: E501
-    system_easy_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_EASY_CLASS_TEMPLATE) # noqa: E501
-    human_easy_prompt = HumanMessagePromptTemplate.from_template(HUMAN_EASY_CLASS_TEMPLATE) # noqa: E501
-    easy_prompt = ChatPromptTemplate.from_messages([system_easy_prompt, human_easy_prompt]) # noqa: E501
-    system_medium_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_NON_NESTED_CLASS_TEMPLATE) # noqa: E501
-    human_medium_prompt = HumanMessagePromptTemplate.from_template(HUMAN_NON_NESTED_CLASS_TEMPLATE) # noqa: E501
-    medium_prompt = ChatPromptTemplate.from_messages([system_medium_prompt, human_medium_prompt]) # noqa: E501
-    system_hard_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_NESTED_CLASS_TEMPLATE) # noqa: E501
-    human_hard_prompt = HumanMessagePromptTemplate.from_template(HUMAN_NESTED_CLASS_TEMPLATE) # noqa: E501
-    hard_prompt = ChatPromptTemplate.from_messages([system_hard_prompt, human_hard_prompt]) # noqa: E501
-    system_correction_prompt = SystemMessagePromptTemplate.from_template(SYSTEM_SELF_CORRECTION_PROMPT) # noqa: E501
-    human_correction_prompt = HumanMessagePromptTemplate.from_template(HUMAN_SELF_CORRECTION_PROMPT) # noqa: E501
-    correction_prompt = ChatPromptTemplate.from_messages([system_correction_prompt, human_correction_prompt]) # noqa: E501
-
-    with open(PREPROCESSING_DEV_TABLE_DESCRIPTIONS, 'r') as file:
-        tables_descriptions = json.load(file)
-
-    accuracy = 0
-    for index,row in dev_df.iterrows():
-        if index < start_index:
-            continue
-
-        CHAT = get_langchain_llm_4()
-        time_diff = datetime.datetime.now() - last_reset_time
-        # Check if 50 minutes have passed
-        if time_diff.total_seconds() >= 100:
-            # If yes, update the chat variable and reset the last reset time
-            last_reset_time = datetime.datetime.now()
-            print('RESET',last_reset_time)
-        else:
-            print('SKIP, ', last_reset_time, time_diff.total_seconds())
-
-        print("Processing row: ", index)
-        db_uri = BIRD_DEV_DATABASES_PATH + "/" + row["db_id"] + "/" + row["db_id"] + ".sqlite"
-        question = row["question"]
-        db_id = row["db_id"]
-        hint = str(row["evidence"])
-        db_descriptions = BIRD_DEV_DATABASES_PATH + "/" + row["db_id"] + "/" + BIRD_DATABASE_DB_DESCRIPTION_DIR  # noqa: E501
-        print("Database: ", db_uri)
-        # columns_descriptions = table_descriptions_parser(db_descriptions)
-        # schema = get_database_schema(db_uri)
-        print("Question: ", question)
-        question_id = row["question_id"]
-
-        # --------- DFIN -> Focused context --------------
-
-        schema, columns_descriptions = get_dfin_focused_schema_context(
-            annotated_db_descriptions_path=db_descriptions,
-            db_uri=db_uri,
-            question_id=question_id
-        )
+    return {
+        "schema_linking": chat_prompt(SYSTEM_SCHEMA_LINKING_TEMPLATE, HUMAN_SCHEMA_LINKING_TEMPLATE),
+        "classification": chat_prompt(SYSTEM_CLASSIFICATION_TEMPLATE, HUMAN_CLASSIFICATION_TEMPLATE),
+        "easy": chat_prompt(SYSTEM_EASY_CLASS_TEMPLATE, HUMAN_EASY_CLASS_TEMPLATE),
+        "non_nested": chat_prompt(SYSTEM_NON_NESTED_CLASS_TEMPLATE, HUMAN_NON_NESTED_CLASS_TEMPLATE),
+        "nested": chat_prompt(SYSTEM_NESTED_CLASS_TEMPLATE, HUMAN_NESTED_CLASS_TEMPLATE),
+        "self_correction": chat_prompt(SYSTEM_SELF_CORRECTION_PROMPT, HUMAN_SELF_CORRECTION_PROMPT),
+    }
+
+
+def process_question(index: int, row) -> Dict:
+    """
+    Runs the DIN-SQL stages of one dev question in order and returns its log entry.
+
+    Safe to run for several questions at once: the LLMs, caches and limiters are shared and thread-safe, and
+    nothing is printed or written here, the caller does it in question order.
+    """
+    from langchain.chains import LLMChain
+
+    chat, sql_chat, correction_chat = get_chat_models()
+    prompts = build_prompts()
+    db_uri = BIRD_DEV_DATABASES_PATH + "/" + row["db_id"] + "/" + row["db_id"] + ".sqlite"
+    question = row["question"]
+    db_id = row["db_id"]
+    hint = str(row["evidence"])
+    db_descriptions = BIRD_DEV_DATABASES_PATH + "/" + row["db_id"] + "/" + BIRD_DATABASE_DB_DESCRIPTION_DIR  # noqa: E501
+    # columns_descriptions = table_descriptions_parser(db_descriptions)
+    # schema = get_database_schema(db_uri)
+    question_id = row["question_id"]
+
+    # --------- DFIN -> Focused context --------------
+
+    schema, columns_descriptions = get_dfin_focused_schema_context(
+        annotated_db_descriptions_path=db_descriptions,
+        db_uri=db_uri,
+        question_id=question_id
+    )
 
-        # -------------------------------------------------
+    # -------------------------------------------------
 
-        chain = LLMChain(llm=CHAT, prompt=schema_linking_prompt, verbose=False)
+    chain = LLMChain(llm=chat, prompt=prompts["schema_linking"], verbose=False)
+    with llm_stage("schema_linking", db_id):
         schema_linking = chain.run(question=question, schema=schema, hint=hint, columns_descriptions=columns_descriptions) # noqa: E501
-        schema_links = extract_schema_links(schema_linking)
-        print(schema_links)
-        chain = LLMChain(llm=CHAT, prompt=classification_prompt)
+    schema_links = extract_schema_links(schema_linking)
+    chain = LLMChain(llm=chat, prompt=prompts["classification"])
+    with llm_stage("classification", db_id):
         classification = chain.run(
             question=question,
             schema=schema,
             hint=hint,
             columns_descriptions=columns_descriptions,
             schema_links=schema_links)
-        label, sub_questions = extract_label_and_sub_questions(classification)
-        print("Label: ", label)
-        sql_generation = None
-        if "EASY" in label:
-            chain = LLMChain(llm=CHAT, prompt=easy_prompt)
-            easy = chain.run(
-                question=question,
-                schema=schema,
-                hint=hint,
-                columns_descriptions=columns_descriptions,
-                schema_links=schema_links)
-            sql_query = extract_sql_query(easy)
-            sql_generation = easy
-        elif "NON-NESTED" in label:     
-            chain = LLMChain(llm=CHAT, prompt=medium_prompt)
-            medium = chain.run(
-                question=question,
-                schema=schema,
-                hint=hint,
-                columns_descriptions=columns_descriptions,
-                schema_links=schema_links)
-            sql_query = extract_sql_query(medium)
-            sql_generation = medium
-        else:
-            chain = LLMChain(llm=CHAT, prompt=hard_prompt)
-            hard = chain.run(
-                question=question,
-                schema=schema,
-                hint=hint,
-                columns_descriptions=columns_descriptions,
-                schema_links=schema_links,
-                sub_questions=sub_questions)
-            sql_query = extract_sql_query(hard)
-            sql_generation = hard
-        chain = LLMChain(llm=CHAT, prompt=correction_prompt)
+    label, sub_questions = extract_label_and_sub_questions(classification)
+    if "EASY" in label:
+        stage, extra_inputs = "easy", {}
+    elif "NON-NESTED" in label:
+        stage, extra_inputs = "non_nested", {}
+    else:
+        stage, extra_inputs = "nested", {"sub_questions": sub_questions}
+    chain = LLMChain(llm=sql_chat, prompt=prompts[stage])
+    with llm_stage(stage, db_id):
+        sql_generation = chain.run(
+            question=question,
+            schema=schema,
+            hint=hint,
+            columns_descriptions=columns_descriptions,
+            schema_links=schema_links,
+            **extra_inputs)
+    sql_query = extract_sql_query(sql_generation)
+    chain = LLMChain(llm=correction_chat, prompt=prompts["self_correction"])
+    with llm_stage("self_correction", db_id):
         correction = chain.run(
             question=question,
             schema=schema,
             columns_descriptions=columns_descriptions,
             hint=hint,
             sql_query=sql_query)
-        finall_sql = extract_revised_sql_query(correction)
-        if finall_sql is not None:
-            one_liner_sql_query = finall_sql.replace('\n', '').replace('\r', '')
+    finall_sql = extract_revised_sql_query(correction)
+    if finall_sql is not None:
+        one_liner_sql_query = finall_sql.replace('\n', '').replace('\r', '')
+    else:
+        if sql_query is not None:
+            one_liner_sql_query = sql_query.replace('\n', '').replace('\r', '')
         else:
-            if sql_query is not None:
-                one_liner_sql_query = sql_query.replace('\n', '').replace('\r', '')
-            else:
-                one_liner_sql_query = "SELECT * FROM table" # no query generated, placeholder to avoid errors # noqa: E501
-        new_row_df = pd.DataFrame(
-            [[question,row["SQL"],row["db_id"],one_liner_sql_query,schema_linking, classification, sql_generation, correction]],  # noqa: E501
-            columns=["question","gold_query","db_id","final_query","schema_linking","classification","sql_generation","self_correction"])
-        logs_df = pd.concat([logs_df, new_row_df], ignore_index=True)
-        logs_df.to_csv(LOGS_PATH, index=False)
-        update_json_file(OUTPUT_PREDICT_JSON, index, one_liner_sql_query, row["db_id"])
-        print("final sql query: ", one_liner_sql_query)
-        print("Gold sql query: ", row["SQL"])
-        print("--------------------------------------------------")
+            one_liner_sql_query = "SELECT * FROM table" # no query generated, placeholder to avoid errors # noqa: E501
+    return {
+        "index": index,
+        "question_id": question_id,
+        "db_uri": db_uri,
+        "schema_links": schema_links,
+        "label": label,
+        "question": question,
+        "gold_query": row["SQL"],
+        "db_id": db_id,
+        "final_query": one_liner_sql_query,
+        "schema_linking": schema_linking,
+        "classification": classification,
+        "sql_generation": sql_generation,
+        "self_correction": correction,
+    }
+
+
+# Outcome of a question in the run log
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+
+def process_question_or_error(index: int, row) -> Dict:
+    """
+    process_question, with a failure (e.g. retries exhausted during a throttling outage) returned as an error entry,
+    so the other questions go on and a resumed run retries this one only.
+    """
+    try:
+        return {**process_question(index, row), "status": STATUS_OK, "error": None}
+    except Exception as e:
+        return {
+            "index": index,
+            "question_id": row["question_id"],
+            "question": row["question"],
+            "gold_query": row["SQL"],
+            "db_id": row["db_id"],
+            "status": STATUS_ERROR,
+            "error": f"{type(e).__name__}: {e}",
+        }
 
 
+def pending_rows(rows: List[Tuple[int, "pd.Series"]], predictions: PredictionJournal, run_log: str
+                 ) -> List[Tuple[int, "pd.Series"]]:
+    """The rows without a prediction of this run configuration yet: never processed or errored in an earlier run."""
+    completed = predictions.question_ids()
+    errored = {entry["question_id"] for entry in read_run_log(run_log) if entry.get("status") == STATUS_ERROR}
+    pending = [(index, row) for index, row in rows if row["question_id"] not in completed]
+    retried = sum(row["question_id"] in errored for _, row in pending)
+    print(f"Resume: {len(rows) - len(pending)} questions skipped (already predicted), {len(pending)} pending "
+          f"({retried} errored in an earlier run)")
+    return pending
+
+
+LOG_COLUMNS = ["question","gold_query","db_id","final_query","schema_linking","classification","sql_generation","self_correction","status","error"]
+
+
+@click.command()
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY, show_default=True, type=int,
+              help='Questions processed at once (DFIN_CONCURRENCY), each one still runs its stages in order')
+@click.option('--run-log', default=RUN_LOG_PATH, show_default=True, help='Append-only JSON lines log of the run')
+@click.option('--compact-logs', type=click.Choice(COMPACT_FORMATS + ["none"]), default=CSV, show_default=True,
+              help=f'Also write the run log as one table to {LOGS_PATH} (or .parquet) at the end')
+@click.option('--predictions-journal', default=PREDICTIONS_JOURNAL_PATH, show_default=True,
+              help=f'Append-only journal of the predicted SQL, materialized as {OUTPUT_PREDICT_JSON}')
+@click.option('--materialize-every', default=50, show_default=True, type=int,
+              help=f'Rewrite {OUTPUT_PREDICT_JSON} every this many questions, 0 for at the end only')
+@click.option('--links-file', help='Preprocessed column links, overrides --links-mode and --links-top-k')
+@click.option('--links-mode', type=click.Choice(LINK_TABLE_MODES), default=MINIMAL, show_default=True,
+              help=f'Table linking mode of the column links in {LINKED_COLUMNS_DIR}')
+@click.option('--links-top-k', default=15, show_default=True, type=int,
+              help=f'Top k columns of the column links in {LINKED_COLUMNS_DIR}')
+@click.option('--resume/--no-resume', default=True, show_default=True,
+              help='Skip the questions with a prediction in the journal, errored ones are retried')
+def main(concurrency, run_log, compact_logs, predictions_journal, materialize_every, links_file, links_mode,
+         links_top_k, resume):
+    global column_links_path
+    if compact_logs == PARQUET and not parquet_engine_available():
+        raise click.BadParameter("Parquet output needs pyarrow or fastparquet installed", param_hint="--compact-logs")
+    prompt_version = prompt_templates_version(
+        SYSTEM_SCHEMA_LINKING_TEMPLATE, HUMAN_SCHEMA_LINKING_TEMPLATE, SYSTEM_CLASSIFICATION_TEMPLATE,
+        HUMAN_CLASSIFICATION_TEMPLATE, SYSTEM_EASY_CLASS_TEMPLATE, HUMAN_EASY_CLASS_TEMPLATE,
+        SYSTEM_NON_NESTED_CLASS_TEMPLATE, HUMAN_NON_NESTED_CLASS_TEMPLATE, SYSTEM_NESTED_CLASS_TEMPLATE,
+        HUMAN_NESTED_CLASS_TEMPLATE, SYSTEM_SELF_CORRECTION_PROMPT, HUMAN_SELF_CORRECTION_PROMPT,
+    )
+    # Cached completions are reused only while all the prompt templates stay unchanged
+    enable_langchain_completion_cache(prompt_version)
+    # Built before the workers start, so they all share them
+    get_chat_models()
+    build_prompts()
+    column_links_path = links_file or column_links_file(LINKED_COLUMNS_DIR, links_mode, links_top_k)
+    if not os.path.exists(column_links_path):
+        raise click.BadParameter(f"{column_links_path} does not exist, run dfin_sql_focus_step.py --steps columns "
+                                 f"first", param_hint="--links-file")
+    links = get_preprocessed_linked_columns()
+    print(f"Column links: {len(links)} questions in {column_links_path}"
+          + (" (index built)" if links.index_built else ""))
+
+    dev_df = load_dev_df()
+    # Predictions of another links file or other prompts are neither skipped nor published by this run
+    run_config = {"links_file": os.path.normpath(column_links_path), "prompt_version": prompt_version}
+    predictions = PredictionJournal(predictions_journal, OUTPUT_PREDICT_JSON, run_config)
+    rows = list(dev_df.iterrows())
+    if resume:
+        rows = pending_rows(rows, predictions, run_log)
+
+    reporter = status_reporter().start()
+    logs = RunLog(run_log)
+    errors = 0
+    try:
+        # Results come back in question order, so the logs and predictions are the same whatever the concurrency
+        results = map_ordered(lambda item: process_question_or_error(*item), rows, concurrency, "question")
+        for processed, result in enumerate(results, start=1):
+            print("Processing row: ", result["index"])
+            if result["status"] == STATUS_ERROR:
+                errors += 1
+                print("Question: ", result["question"])
+                print("Error: ", result["error"])
+                print("--------------------------------------------------")
+                logs.append({key: result.get(key) for key in ["index", "question_id"] + LOG_COLUMNS})
+                continue
+            print("Database: ", result["db_uri"])
+            print("Question: ", result["question"])
+            print(result["schema_links"])
+            print("Label: ", result["label"])
+            logs.append({key: result[key] for key in ["index", "question_id"] + LOG_COLUMNS})
+            predictions.record(result["index"], result["final_query"], result["db_id"], result["question_id"])
+            if materialize_every and processed % materialize_every == 0:
+                predictions.materialize()
+            print("final sql query: ", result["final_query"])
+            print("Gold sql query: ", result["gold_query"])
+            print("--------------------------------------------------")
+    finally:
+        reporter.stop()
+        logs.close()
+        predictions.close()
+        # Also when interrupted, the journal keeps everything predicted so far
+        print(f"{predictions.materialize()} predictions written to {OUTPUT_PREDICT_JSON}")
+    if errors:
+        print(f"{errors} questions errored, run again to retry them only")
+    if compact_logs != "none":
+        logs_path = LOGS_PATH if compact_logs == CSV else os.path.splitext(LOGS_PATH)[0] + ".parquet"
+        rows_written = compact_run_log(run_log, logs_path, LOG_COLUMNS, output_format=compact_logs)
+        print(f"Run log compacted into {logs_path} ({rows_written} questions)")
+    print(COLUMN_RANKER_CACHE.format_stats())
+    print(RETRY_STATS.format_stats())
+    print(format_rate_limiter_stats())
+    print(HTTP_TIMINGS.format_stats())
+    print(STREAMING_STATS.format_stats())
+    print(USAGE_METRICS.format_report())
+    print(f"Completion cache: {COMPLETION_CACHE.store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
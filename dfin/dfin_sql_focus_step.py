@@ -4,8 +4,16 @@ import click
 from typing import List, Dict
 
 from consts import *
-from utils.azure_openai import get_embedding
-from link_columns import get_column_links_for_tables
+from utils.azure_openai import get_embeddings, batch_embedding_inputs, set_embedding_cache_mode, \
+    AZ_OAI_EMBEDDING_MAX_INPUTS, AZ_OAI_EMBEDDING_MAX_TOKENS, EMBEDDING_CACHE_MODE, EMBEDDING_CACHE_MODES
+from link_columns import get_column_links_for_tables, get_column_links_for_questions
+from utils.column_ranker_cache import COLUMN_RANKER_CACHE
+from utils.http_sessions import HTTP_TIMINGS
+from utils.retry_policy import RETRY_STATS
+from utils.usage_metrics import USAGE_METRICS
+from utils.azure_openai import format_rate_limiter_stats
+from utils.embeddings_store import PRECISIONS
+from utils.links_store import column_links_file
 from link_schema_tables import predict_linked_tables
 
 
@@ -52,6 +60,30 @@ def save_results_incrementally(file_path: str, data: dict):
         f.truncate()
 
 
+def save_results_bulk(file_path: str, results: List[dict]):
+    # Same merge-by-question_id semantics as save_results_incrementally, with a single rewrite of the file
+    directory = os.path.dirname(file_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    existing_data = []
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as f:
+            existing_data = json.load(f)
+
+    positions = {entry["question_id"]: index for index, entry in enumerate(existing_data)}
+    for data in results:
+        question_id = data["question_id"]
+        if question_id in positions:
+            existing_data[positions[question_id]] = data
+        else:
+            positions[question_id] = len(existing_data)
+            existing_data.append(data)
+
+    with open(file_path, 'w') as f:
+        json.dump(existing_data, f, indent=4)
+
+
 def link_tables_and_persist(
         dataset: List[Dict[str, str]],
         preprocessed_tables_descriptions: List[Dict[str, str]],
@@ -108,10 +140,13 @@ def link_columns_and_persist(dataset: List[Dict[str, str]], linked_tables_result
 def compute_and_persist_questions_embeddings(
         dataset: List[Dict[str, str]],
         output_file: str,
-        from_question_id: int = 0
+        from_question_id: int = 0,
+        max_inputs: int = AZ_OAI_EMBEDDING_MAX_INPUTS,
+        max_tokens: int = AZ_OAI_EMBEDDING_MAX_TOKENS
 ):
-    embeddings_results = []
-    for index, row in enumerate(dataset):
+    question_ids = []
+    embedding_strs = []
+    for row in dataset:
         question_id = int(row["question_id"])
         if question_id < from_question_id:
             continue
@@ -121,18 +156,24 @@ def compute_and_persist_questions_embeddings(
         embedding_str = f"{question}"
         if hint:
             embedding_str += f"\thint: {hint}"
-        embedding = get_embedding(embedding_str)
-
-        result = {
-            "question_id": question_id,
-            "embedding": embedding
-        }
-
-        embeddings_results.append(result)
-        print(f"Computed embedding for question {index}/{len(dataset)}, question id: {question_id}")
-
-        # Save results incrementally
-        save_results_incrementally(output_file, result)
+        question_ids.append(question_id)
+        embedding_strs.append(embedding_str)
+
+    # Many questions per request, the results keep the input order
+    for batch in batch_embedding_inputs(embedding_strs, max_inputs, max_tokens):
+        embeddings = get_embeddings([embedding_strs[i] for i in batch], max_inputs, max_tokens)
+        results = [
+            {
+                "question_id": question_ids[i],
+                "embedding": embedding
+            }
+            for i, embedding in zip(batch, embeddings)
+        ]
+        print(f"Computed embeddings for questions {batch[-1] + 1}/{len(question_ids)}, "
+              f"question ids: {question_ids[batch[0]]}-{question_ids[batch[-1]]}")
+
+        # Save results incrementally, once per batch
+        save_results_bulk(output_file, results)
     print("Embeddings results persisted to", output_file)
 
 
@@ -143,6 +184,7 @@ def compute_and_persist_column_links(
     output_file: str,
     from_question_id: int = 0,
     top_k: int = 15,
+    search: str = EXACT_COLUMN_SEARCH,
 ):
     # Load precomputed embeddings and linked tables
     with open(embeddings_file, 'r') as f:
@@ -166,7 +208,8 @@ def compute_and_persist_column_links(
             db_id=db_id,
             question_embedding=embedding,
             table_links=table_links,
-            top_k=top_k
+            top_k=top_k,
+            search=search
         )
 
         result = {
@@ -181,6 +224,53 @@ def compute_and_persist_column_links(
     print("Column links results persisted to", output_file)
 
 
+def compute_and_persist_column_links_batched(
+    dataset: List[Dict[str, str]],
+    embeddings_file: str,
+    linked_tables_file: str,
+    output_file: str,
+    from_question_id: int = 0,
+    top_k: int = 15,
+    search: str = EXACT_COLUMN_SEARCH,
+):
+    # Load precomputed embeddings and linked tables
+    with open(embeddings_file, 'r') as f:
+        embeddings_data = json.load(f)
+    embeddings_dict = {entry["question_id"]: entry["embedding"] for entry in embeddings_data}
+
+    with open(linked_tables_file, 'r') as f:
+        linked_tables_data = json.load(f)
+    linked_tables_dict = {entry["question_id"]: entry["linked_tables"] for entry in linked_tables_data}
+
+    # Group the questions by database, they share the same column embeddings
+    questions_per_db = {}
+    for row in dataset:
+        question_id = int(row["question_id"])
+        if question_id < from_question_id:
+            continue
+        questions_per_db.setdefault(row["db_id"], []).append(question_id)
+
+    results = {}
+    for db_id, question_ids in questions_per_db.items():
+        column_links_per_question = get_column_links_for_questions(
+            db_id=db_id,
+            question_embeddings=[embeddings_dict[question_id] for question_id in question_ids],
+            table_links_per_question=[linked_tables_dict[question_id] for question_id in question_ids],
+            top_k=top_k,
+            search=search
+        )
+        for question_id, column_links in zip(question_ids, column_links_per_question):
+            results[question_id] = {
+                "question_id": question_id,
+                "column_links": column_links
+            }
+        print(f"Computed column links for {len(question_ids)} questions of {db_id}")
+
+    # Persist once, in dataset order
+    save_results_bulk(output_file, [results[int(row["question_id"])] for row in dataset if int(row["question_id"]) in results])
+    print("Column links results persisted to", output_file)
+
+
 def validate_mode(ctx, param, value):
     steps = ctx.params.get('steps')
     if steps in ['all', 'tables'] and value is None:
@@ -194,7 +284,21 @@ def validate_mode(ctx, param, value):
 @click.option('--mode', type=click.Choice(LINK_TABLE_MODES), callback=validate_mode, help='Mode for table linking')
 @click.option('--from-question-id', default=0, show_default=True, help='Start processing from this question id')
 @click.option('--top-k', default=15, show_default=True, type=int, help='Top k columns to consider for linking')
-def main(dataset_file_path, steps, mode, from_question_id, top_k):
+@click.option('--batch-columns/--no-batch-columns', default=True, show_default=True, help='Link the columns of all questions of a database at once')
+@click.option('--column-search', type=click.Choice(COLUMN_SEARCH_MODES), default=EXACT_COLUMN_SEARCH, show_default=True, help='Exact or approximate (IVF index) column retrieval')
+@click.option('--embedding-max-inputs', default=AZ_OAI_EMBEDDING_MAX_INPUTS, show_default=True, type=int, help='Max inputs per embeddings request')
+@click.option('--embedding-max-tokens', default=AZ_OAI_EMBEDDING_MAX_TOKENS, show_default=True, type=int, help='Max tokens per embeddings request')
+@click.option('--embedding-cache-mode', type=click.Choice(EMBEDDING_CACHE_MODES), default=EMBEDDING_CACHE_MODE, show_default=True, help='Use "offline" to only serve embeddings from the on-disk cache')
+@click.option('--embeddings-precision', type=click.Choice(PRECISIONS), help='Precision of the resident column embeddings (default: $DFIN_EMBEDDINGS_PRECISION or float32)')
+@click.option('--embeddings-cache-mb', type=float, help='Memory cap of the in-process column embeddings cache (default: $DFIN_EMBEDDINGS_CACHE_MB or 512)')
+def main(dataset_file_path, steps, mode, from_question_id, top_k, batch_columns, column_search, embedding_max_inputs,
+         embedding_max_tokens, embedding_cache_mode, embeddings_precision, embeddings_cache_mb):
+    set_embedding_cache_mode(embedding_cache_mode)
+    if embeddings_precision:
+        COLUMN_RANKER_CACHE.precision = embeddings_precision
+    if embeddings_cache_mb is not None:
+        COLUMN_RANKER_CACHE.resize(int(embeddings_cache_mb * 2 ** 20))
+
     # File paths
     preprocessed_tables_descriptions_file_path = PREPROCESSING_DEV_TABLE_DESCRIPTIONS
 
@@ -218,22 +322,32 @@ def main(dataset_file_path, steps, mode, from_question_id, top_k):
         compute_and_persist_questions_embeddings(
             dataset,
             QUESTION_EMBEDDINGS_PATH,
-            from_question_id
+            from_question_id,
+            embedding_max_inputs,
+            embedding_max_tokens
         )
 
     if steps in ['columns', 'all']:
-        column_links_output_file = f"{LINKED_COLUMNS_DIR}/column_links_results_{mode}_top_k_{top_k}.json"
-        compute_and_persist_column_links(
+        column_links_output_file = column_links_file(LINKED_COLUMNS_DIR, mode, top_k)
+        link_columns = compute_and_persist_column_links_batched if batch_columns else compute_and_persist_column_links
+        link_columns(
             dataset,
             QUESTION_EMBEDDINGS_PATH,
             linked_tables_output_file,
             column_links_output_file,
             from_question_id,
-            top_k
+            top_k,
+            column_search
         )
 
     # Columns linking and persisting will be added here later
 
+    print(COLUMN_RANKER_CACHE.format_stats())
+    print(RETRY_STATS.format_stats())
+    print(format_rate_limiter_stats())
+    print(HTTP_TIMINGS.format_stats())
+    print(USAGE_METRICS.format_report())
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,101 @@
+import json
+from typing import Dict, List
+
+import click
+
+from consts import *
+from utils.column_ranker import ColumnRanker
+from utils.embeddings_store import load_embeddings_store, PRECISIONS, FLOAT32
+from utils.ivf_index import ann_recall
+
+
+def load_gold_columns(gold_links_json_path: str) -> Dict[int, Dict[str, List[str]]]:
+    with open(gold_links_json_path, 'r') as f:
+        gold_data = json.load(f)
+    # Same normalization as slam_analysis.analyze_linked_columns
+    return {
+        entry["question_id"]: {table.lower(): [col.lower().strip() for col in columns]
+                               for table, columns in entry["columns"].items()}
+        for entry in gold_data
+    }
+
+
+def column_recall(gold_columns: Dict[str, List[str]], linked_columns: Dict[str, List[str]]) -> float:
+    linked = {table.lower(): {col.lower().strip() for col in columns} for table, columns in linked_columns.items()}
+    recalls = []
+    for table, columns in gold_columns.items():
+        gold_set = set(columns)
+        if gold_set:
+            recalls.append(len(gold_set & linked.get(table, set())) / len(gold_set))
+    return sum(recalls) / len(recalls) if recalls else 1
+
+
+@click.command()
+@click.option('--dataset-file-path', default=BIRD_DEV_JSON_PATH, show_default=True)
+@click.option('--gold-links-file', default=f'{DB_PREPROCESSING_DIR}/dev_gold_links.json', show_default=True)
+@click.option('--embeddings-file', default=QUESTION_EMBEDDINGS_PATH, show_default=True)
+@click.option('--linked-tables-file', help='Rank within these predicted tables instead of the gold tables')
+@click.option('--embeddings-dir', default=PREPROCESSING_DEV_DB_EMBEDDINGS_PATH, show_default=True)
+@click.option('--top-k', multiple=True, type=int, default=[5, 10, 15], show_default=True)
+@click.option('--precision', 'precisions', multiple=True, type=click.Choice(PRECISIONS), default=PRECISIONS, show_default=True)
+def main(dataset_file_path, gold_links_file, embeddings_file, linked_tables_file, embeddings_dir, top_k, precisions):
+    """
+    Compares top-k column recall against the gold links for each precision of the column embeddings.
+
+    The overlap@k columns give the share of the float32 top-k columns each precision still retrieves.
+    """
+    with open(dataset_file_path, 'r') as f:
+        dataset = json.load(f)
+    with open(embeddings_file, 'r') as f:
+        embeddings_dict = {entry["question_id"]: entry["embedding"] for entry in json.load(f)}
+    gold_columns = load_gold_columns(gold_links_file)
+
+    # The gold tables by default, so the numbers only reflect the column ranking
+    gold_tables = {question_id: list(columns) for question_id, columns in gold_columns.items()}
+    if linked_tables_file:
+        with open(linked_tables_file, 'r') as f:
+            table_links = {entry["question_id"]: entry["linked_tables"] for entry in json.load(f)}
+    else:
+        table_links = None
+
+    questions_per_db = {}
+    for row in dataset:
+        question_id = int(row["question_id"])
+        if question_id in embeddings_dict and question_id in gold_columns:
+            questions_per_db.setdefault(row["db_id"], []).append(question_id)
+
+    print(f"{'precision':<10}{'MB':>8}" + "".join(f"{f'recall@{k}':>12}{f'overlap@{k}':>12}" for k in top_k))
+    reference = {}
+    for precision in [FLOAT32] + [p for p in precisions if p != FLOAT32]:
+        total_bytes = 0
+        recalls = {k: [] for k in top_k}
+        agreements = {k: [] for k in top_k}
+        for db_id, question_ids in questions_per_db.items():
+            ranker = ColumnRanker(load_embeddings_store(embeddings_dir, db_id), precision=precision)
+            total_bytes += ranker.nbytes
+
+            # Gold links use the original table casing loosely, match tables case-insensitively
+            tables_by_lower = {table.lower(): table for table in ranker.table_rows}
+            if table_links is not None:
+                tables_per_question = [table_links.get(question_id, []) for question_id in question_ids]
+            else:
+                tables_per_question = [[tables_by_lower.get(table, table) for table in gold_tables[question_id]]
+                                       for question_id in question_ids]
+
+            for k in top_k:
+                results = ranker.rank_batch([embeddings_dict[q] for q in question_ids], tables_per_question, k)
+                for question_id, result in zip(question_ids, results):
+                    recalls[k].append(column_recall(gold_columns[question_id], result))
+                    if precision == FLOAT32:
+                        reference[(question_id, k)] = result
+                    # Share of the float32 top-k columns that are still retrieved
+                    agreements[k].append(ann_recall([reference[(question_id, k)]], [result]))
+
+        if precision in precisions:
+            print(f"{precision:<10}{total_bytes / 2 ** 20:>8.2f}" + "".join(
+                f"{sum(recalls[k]) / len(recalls[k]):>12.4f}{sum(agreements[k]) / len(agreements[k]):>12.4f}"
+                for k in top_k))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,14 @@
 import json
 import os
 import re
-import ast
-from typing import List, Tuple, Dict
+from typing import TYPE_CHECKING, List, Tuple, Dict
 
-import pandas as pd
-from langchain.utilities.sql_database import SQLDatabase
-from sklearn.metrics.pairwise import cosine_similarity
+from consts import PREPROCESSING_DEV_DB_EMBEDDINGS_PATH, EXACT_COLUMN_SEARCH, ANN_COLUMN_SEARCH, COLUMN_SEARCH_MODES
+from utils.column_ranker import ColumnRanker, DEFAULT_N_PROBE
+from utils.column_ranker_cache import COLUMN_RANKER_CACHE
+
+if TYPE_CHECKING:
+    from langchain.utilities.sql_database import SQLDatabase
 
 
 DB_TABLES_RELATION = None
@@ -82,6 +84,8 @@ def find_primary_and_foreign_keys(db_id, table_name):
 
 
 def get_table_create_statement_with_sample(db_uri, table_name):
+    from langchain.utilities.sql_database import SQLDatabase
+
     db = SQLDatabase.from_uri("sqlite:///"+db_uri)
     db._sample_rows_in_table_info = 0
     return db.get_table_info_no_throw([table_name])
@@ -149,7 +153,7 @@ def filter_columns_within_boundaries(create_table: str, start_line: int, end_lin
     return filtered_sql, ordered_columns
 
 
-def get_filtered_sample(db: SQLDatabase, table_name, columns_to_keep) -> str:
+def get_filtered_sample(db: "SQLDatabase", table_name, columns_to_keep) -> str:
     if table_name == 'order':
         table_name = "'order'"
     sample = db._execute(f"SELECT * FROM {table_name} LIMIT 3;")
@@ -185,6 +189,8 @@ def filter_create_table(create_table: str, columns_to_keep: List[str]) -> Tuple[
 
 
 def get_filtered_table_context(db_uri: str, table_name: str, columns_to_keep: List[str]) -> str:
+    from langchain.utilities.sql_database import SQLDatabase
+
     db = SQLDatabase.from_uri(f"sqlite:///{db_uri}")
     db._sample_rows_in_table_info = 0
     create_table = db.get_table_info_no_throw([table_name])
@@ -197,6 +203,8 @@ def get_filtered_table_context(db_uri: str, table_name: str, columns_to_keep: Li
 
 
 def table_descriptions_filtered_parser(database_dir, table_name, columns_to_keep):
+    import pandas as pd
+
     file_path = os.path.join(database_dir, f"{table_name}.csv")
     db_descriptions = f"Table: {table_name}\n"
 
@@ -222,23 +230,14 @@ def table_descriptions_filtered_parser(database_dir, table_name, columns_to_keep
     return db_descriptions
 
 
-def get_top_k_columns(top_k: int, question_embedding: List[float], db_id: str, table_name: str) -> List[str]:
-    # Load the CSV file
-    df = pd.read_csv(f'db_preprocessing/column_description_embeddings/{db_id}.csv')
-
-    # Filter the DataFrame
-    df = df[df['table_name'] == table_name]
-
-    # Convert the embedding strings back to lists of floats
-    df['embedding'] = df['embedding'].apply(ast.literal_eval)
-
-    # Calculate cosine similarity
-    df['similarity'] = df.apply(lambda row: cosine_similarity([question_embedding], [row['embedding']])[0][0], axis=1)
+def get_column_ranker(db_id: str) -> ColumnRanker:
+    # Shared across calls and threads, reloaded only when the embeddings shard changes
+    return COLUMN_RANKER_CACHE.get(PREPROCESSING_DEV_DB_EMBEDDINGS_PATH, db_id)
 
-    # Sort by similarity and get top K original column names
-    top_k_columns = df.nlargest(top_k, 'similarity')['original_column_name'].tolist()
 
-    return top_k_columns
+def get_top_k_columns(top_k: int, question_embedding: List[float], db_id: str, table_name: str) -> List[str]:
+    # Rank the columns of the table by cosine similarity and get top K original column names
+    return get_column_ranker(db_id).rank(question_embedding, [table_name], top_k)[table_name]
 
 
 def add_pk_fk_if_relation_exits_with_table_links(db_id, table_links, table_name, top_k_columns):
@@ -275,16 +274,74 @@ def get_focused_columns_for_table(db_id, question_embedding, table_name, table_l
     )
 
 
+def rank_columns(
+    ranker: ColumnRanker,
+    question_embedding,
+    table_links: List[str],
+    top_k: int,
+    search: str = EXACT_COLUMN_SEARCH,
+    n_probe: int = DEFAULT_N_PROBE
+) -> Dict[str, List[str]]:
+    if search == EXACT_COLUMN_SEARCH:
+        return ranker.rank(question_embedding, table_links, top_k)
+    if search == ANN_COLUMN_SEARCH:
+        return ranker.rank_ann(question_embedding, table_links, top_k, n_probe)
+    raise Exception(f"Column search mode is missing use the following: {COLUMN_SEARCH_MODES}")
+
+
 def get_column_links_for_tables(
     db_id: str,
     question_embedding,
     table_links: List[str],
-    top_k: int = 0
+    top_k: int = 0,
+    search: str = EXACT_COLUMN_SEARCH,
+    n_probe: int = DEFAULT_N_PROBE
+) -> Dict[str, List[str]]:
+    # Score the columns of all the linked tables at once
+    top_k_columns_per_table = rank_columns(get_column_ranker(db_id), question_embedding, table_links, top_k, search, n_probe)
+    return add_pk_fk_to_column_links(db_id, table_links, top_k_columns_per_table)
+
+
+def get_column_links_for_questions(
+    db_id: str,
+    question_embeddings: List[List[float]],
+    table_links_per_question: List[List[str]],
+    top_k: int = 0,
+    search: str = EXACT_COLUMN_SEARCH,
+    n_probe: int = DEFAULT_N_PROBE
+) -> List[Dict[str, List[str]]]:
+    ranker = get_column_ranker(db_id)
+    if search == EXACT_COLUMN_SEARCH:
+        # Score all the questions of the database against all its columns at once
+        top_k_columns_per_question = ranker.rank_batch(question_embeddings, table_links_per_question, top_k)
+    else:
+        top_k_columns_per_question = [
+            rank_columns(ranker, question_embedding, table_links, top_k, search, n_probe)
+            for question_embedding, table_links in zip(question_embeddings, table_links_per_question)
+        ]
+    return [
+        add_pk_fk_to_column_links(db_id, table_links, top_k_columns_per_table)
+        for table_links, top_k_columns_per_table in zip(table_links_per_question, top_k_columns_per_question)
+    ]
+
+
+def add_pk_fk_to_column_links(
+    db_id: str,
+    table_links: List[str],
+    top_k_columns_per_table: Dict[str, List[str]]
 ) -> Dict[str, List[str]]:
     table_columns_dict = {}
     for table_name in table_links:
-        columns = get_focused_columns_for_table(db_id, question_embedding, table_name, table_links, top_k)
-        table_columns_dict[table_name] = columns
+        # cleanup (some descriptions have leading whitespace
+        top_k_columns = [col.strip() for col in top_k_columns_per_table[table_name]]
+
+        # As a safety we add all relevant primary keys and foreign keys
+        table_columns_dict[table_name] = add_pk_fk_if_relation_exits_with_table_links(
+            db_id,
+            table_links,
+            table_name,
+            top_k_columns
+        )
     return table_columns_dict
 
 
@@ -1,8 +1,8 @@
 import json
 import re
-import pandas as pd
 from typing import Set, Optional
 from utils.azure_openai import get_completion_4
+from utils.usage_metrics import llm_stage
 from consts import *
 
 
@@ -87,12 +87,13 @@ def predict_linked_tables(question: str,
         ["Table {}: {}".format(desc['table_name'], desc['description']) for desc in db_tables_descriptions])
 
     # Call the linking function
-    if mode == MINIMAL:
-        predicted_tables = get_table_links_minimal(question, hint, descriptions)
-    elif mode == CONSERVATIVE:
-        predicted_tables = get_table_links_conservative(question, hint, descriptions)
-    else:
-        raise Exception(f"Link table mode is missing use the following: {LINK_TABLE_MODES}")
+    with llm_stage("table_linking", db_id):
+        if mode == MINIMAL:
+            predicted_tables = get_table_links_minimal(question, hint, descriptions)
+        elif mode == CONSERVATIVE:
+            predicted_tables = get_table_links_conservative(question, hint, descriptions)
+        else:
+            raise Exception(f"Link table mode is missing use the following: {LINK_TABLE_MODES}")
 
     # Sort tables
     return sorted(list(predicted_tables))
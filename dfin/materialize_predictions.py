@@ -0,0 +1,21 @@
+import click
+
+from consts import OUTPUT_PREDICT_JSON, PREDICTIONS_JOURNAL_PATH
+from utils.prediction_journal import PredictionJournal
+
+
+@click.command()
+@click.option('--predictions-journal', default=PREDICTIONS_JOURNAL_PATH, show_default=True)
+@click.option('--output', default=OUTPUT_PREDICT_JSON, show_default=True)
+def main(predictions_journal, output):
+    """
+    Writes the BIRD predictions JSON from the journal, also while dfin_sql.py is still running, with the predictions
+    of the configuration (links file, prompts) of the latest run.
+    """
+    config = PredictionJournal(predictions_journal, output).latest_config()
+    with PredictionJournal(predictions_journal, output, config) as predictions:
+        print(f"{predictions.materialize()} predictions written to {output} ({config})")
+
+
+if __name__ == '__main__':
+    main()
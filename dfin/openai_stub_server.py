@@ -0,0 +1,328 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+import pandas as pd
+
+from consts import LOGS_PATH, RUN_LOG_PATH
+from utils.tokens import count_tokens
+
+
+# Recorded DIN-SQL steps in the run log, identified by the first line of the human prompt
+LOGGED_STEPS = [
+    ("For the given question, find the schema links", "schema_linking"),
+    ("For the given question, classify it", "classification"),
+    ("Use the schema links to generate", "sql_generation"),
+    ("Use the the schema links and intermediate reasoning steps", "sql_generation"),
+    ("Evaluate the correctness of this query", "self_correction"),
+]
+# Deterministic answers parsed fine by the extract_* helpers when nothing was recorded
+CANNED_ANSWERS = {
+    "schema_linking": "Schema_links: []",
+    "classification": 'Label: "EASY"',
+    "sql_generation": "SQL: SELECT 1",
+    "self_correction": "Revised_SQL: SELECT 1",
+    None: "{}",
+}
+QUESTION_PATTERN = re.compile(r"^Q: (.*)$", re.MULTILINE)
+WORD_PATTERN = re.compile(r"\s*\S+|\s+")
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parses a latency distribution in seconds: `fixed:S`, `uniform:LOW,HIGH`, `normal:MEAN,STD` or
+    `lognormal:MEDIAN,SIGMA` (long tailed, the closest to real completion latencies).
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0)
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(np.log(values[0]), values[1])
+    raise click.BadParameter(f"Unknown latency distribution {spec}, use fixed, uniform, normal or lognormal")
+
+
+def load_transcripts(logs_path: Optional[str]) -> Dict[Tuple[str, str], str]:
+    """Recorded completions by (question, step) from a dfin_sql.py run log, JSON lines or compacted CSV."""
+    if not logs_path:
+        return {}
+    logs_df = pd.read_json(logs_path, lines=True) if logs_path.endswith(".jsonl") else pd.read_csv(logs_path)
+    transcripts = {}
+    for _, row in logs_df.iterrows():
+        for _, step in LOGGED_STEPS:
+            if isinstance(row.get(step), str):
+                transcripts[(row["question"].strip(), step)] = row[step]
+    return transcripts
+
+
+def get_step(prompt: str) -> Optional[str]:
+    head = prompt.lstrip()
+    return next((step for prefix, step in LOGGED_STEPS if head.startswith(prefix)), None)
+
+
+class QuotaWindow:
+    """Requests and tokens admitted over the last minute, the way the service enforces RPM/TPM quotas."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._admitted = deque()
+        self._tokens = 0
+
+    def admit(self, tokens: int, now: float) -> Optional[float]:
+        """Records the request and returns None, or the seconds until it would fit when over quota."""
+        while self._admitted and now - self._admitted[0][0] >= 60:
+            self._tokens -= self._admitted.popleft()[1]
+        over_rpm = self.rpm and len(self._admitted) + 1 > self.rpm
+        over_tpm = self.tpm and self._tokens + tokens > self.tpm
+        if (over_rpm or over_tpm) and self._admitted:
+            return max(60 - (now - self._admitted[0][0]), 0.001)
+        self._admitted.append((now, tokens))
+        self._tokens += tokens
+        return None
+
+
+class StubState:
+    def __init__(self, transcripts: Dict[Tuple[str, str], str], chat_latency: Callable, embedding_latency: Callable,
+                 seconds_per_output_token: float, rate_429: float, rate_500: float, retry_after: float,
+                 rpm: int, tpm: int, embedding_dimensions: int, seed: int):
+        self.transcripts = transcripts
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.seconds_per_output_token = seconds_per_output_token
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.embedding_dimensions = embedding_dimensions
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.quotas: Dict[str, QuotaWindow] = {}
+        self.quota_limits = (rpm, tpm)
+        self.stats = {"requests": 0, "replayed": 0, "canned": 0, "throttled": 0, "errors": 0, "cancelled": 0,
+                      "prompt_tokens": 0, "completion_tokens": 0}
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def draw(self, distribution: Callable) -> float:
+        with self.lock:
+            return distribution(self.rng)
+
+    def inject_fault(self, deployment: str, tokens: int) -> Optional[Tuple[int, float]]:
+        """(status, retry_after) of an injected or quota error, None to answer normally."""
+        with self.lock:
+            quota = self.quotas.setdefault(deployment, QuotaWindow(*self.quota_limits))
+            wait = quota.admit(tokens, time.monotonic()) if any(self.quota_limits) else None
+            if wait is not None:
+                return 429, wait
+            roll = self.rng.random()
+        if roll < self.rate_429:
+            return 429, self.retry_after
+        if roll < self.rate_429 + self.rate_500:
+            return 500, 0
+        return None
+
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        step = get_step(prompt)
+        questions = QUESTION_PATTERN.findall(prompt)
+        if step is not None and questions:
+            recorded = self.transcripts.get((questions[-1].strip(), step))
+            if recorded is not None:
+                self.count("replayed")
+                return recorded
+        self.count("canned")
+        return CANNED_ANSWERS[step]
+
+    def embed(self, text: str) -> List[float]:
+        # Same text, same unit vector, so rankings are reproducible across runs
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.embedding_dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def make_handler(state: StubState):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: Optional[Dict[str, str]] = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _stream_completion(self, deployment: str, content: str, prompt_tokens: int, latency: Callable):
+            """Server-sent events like the service, one chunk per word, paced by --seconds-per-output-token."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            state.count("prompt_tokens", prompt_tokens)
+            time.sleep(state.draw(latency))
+            pieces = [{"role": "assistant", "content": ""}]
+            pieces += [{"content": piece} for piece in WORD_PATTERN.findall(content)]
+            try:
+                for i, delta in enumerate(pieces):
+                    tokens = count_tokens(delta["content"])
+                    time.sleep(tokens * state.seconds_per_output_token)
+                    finish_reason = "stop" if i == len(pieces) - 1 else None
+                    event = {"object": "chat.completion.chunk", "created": int(time.time()), "model": deployment,
+                             "choices": [{"index": 0, "finish_reason": finish_reason, "delta": delta}]}
+                    self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    state.count("completion_tokens", tokens)
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading, e.g. once it had the whole SQL statement
+                state.count("cancelled")
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                with state.lock:
+                    self._send_json(200, dict(state.stats))
+            else:
+                self._send_json(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            state.count("requests")
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            path = self.path.split("?")[0]
+            # /openai/deployments/{deployment}/{operation} like Azure, anything else counts as one deployment
+            match = re.search(r"/deployments/([^/]+)/", path)
+            deployment = match.group(1) if match else "default"
+
+            if path.endswith("/chat/completions"):
+                messages = payload.get("messages", [])
+                prompt_tokens = sum(count_tokens(message.get("content") or "") for message in messages)
+                latency = state.chat_latency
+            elif path.endswith("/embeddings"):
+                inputs = payload.get("input", [])
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                prompt_tokens = sum(count_tokens(text) for text in inputs)
+                latency = state.embedding_latency
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown operation {path}"}})
+                return
+
+            fault = state.inject_fault(deployment, prompt_tokens)
+            if fault is not None:
+                status, retry_after = fault
+                state.count("throttled" if status == 429 else "errors")
+                headers = {"Retry-After": f"{retry_after:.0f}", "retry-after-ms": f"{retry_after * 1000:.0f}"} \
+                    if status == 429 else {}
+                self._send_json(status, {"error": {"code": str(status), "message": "Injected by the stub"}}, headers)
+                return
+
+            if path.endswith("/embeddings"):
+                time.sleep(state.draw(latency))
+                state.count("prompt_tokens", prompt_tokens)
+                self._send_json(200, {
+                    "object": "list",
+                    "data": [{"object": "embedding", "index": i, "embedding": state.embed(text)}
+                             for i, text in enumerate(inputs)],
+                    "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+                })
+                return
+
+            content = state.complete(messages)
+            if payload.get("stream"):
+                self._stream_completion(deployment, content, prompt_tokens, latency)
+                return
+            completion_tokens = count_tokens(content)
+            time.sleep(state.draw(latency) + completion_tokens * state.seconds_per_output_token)
+            state.count("prompt_tokens", prompt_tokens)
+            state.count("completion_tokens", completion_tokens)
+            self._send_json(200, {
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+    return StubHandler
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8765, show_default=True, type=int)
+@click.option('--logs-file', help=f'dfin_sql.py run log to replay completions from, empty for canned answers only '
+                                 f'[default: {RUN_LOG_PATH}, else {LOGS_PATH}, when there]')
+@click.option('--chat-latency', default='lognormal:2,0.5', show_default=True,
+              help='fixed:S, uniform:LOW,HIGH, normal:MEAN,STD or lognormal:MEDIAN,SIGMA (seconds)')
+@click.option('--embedding-latency', default='lognormal:0.1,0.3', show_default=True)
+@click.option('--seconds-per-output-token', default=0.0, show_default=True, type=float,
+              help='Generation time added per completion token')
+@click.option('--rate-429', default=0.0, show_default=True, type=float, help='Share of requests throttled at random')
+@click.option('--rate-500', default=0.0, show_default=True, type=float, help='Share of requests failing at random')
+@click.option('--retry-after', default=1.0, show_default=True, type=float, help='Retry-After of the random 429s')
+@click.option('--rpm', default=0, show_default=True, type=int, help='Requests per minute quota per deployment')
+@click.option('--tpm', default=0, show_default=True, type=int, help='Prompt tokens per minute quota per deployment')
+@click.option('--embedding-dimensions', default=1536, show_default=True, type=int)
+@click.option('--seed', default=0, show_default=True, type=int)
+def main(host, port, logs_file, chat_latency, embedding_latency, seconds_per_output_token, rate_429, rate_500,
+         retry_after, rpm, tpm, embedding_dimensions, seed):
+    """
+    Local stand-in for the Azure OpenAI chat completion and embedding endpoints.
+
+    Point the clients at it with AZ_OAI_API_BASE_GPT_3/GPT_4/GPT_4_32_k=http://HOST:PORT and
+    AZ_OAI_STATIC_TOKEN=stub. Token counts are served at GET /stats and printed on exit.
+    """
+    if logs_file is None:
+        logs_file = next((path for path in (RUN_LOG_PATH, LOGS_PATH) if os.path.exists(path)), "")
+        print(f"Replaying completions from {logs_file}" if logs_file else "No run log found, canned answers only")
+    state = StubState(
+        transcripts=load_transcripts(logs_file),
+        chat_latency=parse_latency(chat_latency),
+        embedding_latency=parse_latency(embedding_latency),
+        seconds_per_output_token=seconds_per_output_token,
+        rate_429=rate_429,
+        rate_500=rate_500,
+        retry_after=retry_after,
+        rpm=rpm,
+        tpm=tpm,
+        embedding_dimensions=embedding_dimensions,
+        seed=seed,
+    )
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    print(f"OpenAI stub listening on http://{host}:{port} ({len(state.transcripts)} recorded completions)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import click
+
+from utils.usage_metrics import USAGE_METRICS, format_usage_report, read_metrics_file
+
+
+@click.command()
+@click.option('--metrics-file', default=USAGE_METRICS.path, show_default=True)
+@click.option('--run-id', help='Report this run only, the last run of the file by default')
+@click.option('--all-runs', is_flag=True, help='Report every run of the file together')
+def main(metrics_file, run_id, all_runs):
+    """Tokens, latency and estimated cost per stage and per database of the LLM calls of a run."""
+    records = read_metrics_file(metrics_file)
+    if not all_runs:
+        run_id = run_id or (records[-1]["run_id"] if records else None)
+        records = [entry for entry in records if entry["run_id"] == run_id]
+        print(f"Run {run_id}")
+    print(format_usage_report(records))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,12 @@
 
-import pandas as pd
 import json
 
 
 def analyze_linked_tables(gold_links_json_path: str = '../../db_preprocessing/dev_gold_links.json',
                           linked_tables_json_path: str = '../../output/linked_tables/linked_tables_results_mode_minimal.json',
                           output_csv_path: str = "table_analysis.csv"):   # Load the gold tables data
+    import pandas as pd
+
     with open(gold_links_json_path, 'r') as file:
         gold_data = json.load(file)
     gold_tables_dict = {entry["question_id"]: set(entry["tables"]) for entry in gold_data}
@@ -81,6 +82,8 @@ def analyze_linked_tables(gold_links_json_path: str = '../../db_preprocessing/de
 
 
 def analyze_linked_columns(gold_links_json_path: str, linked_columns_json_path: str, output_csv_path: str):
+    import pandas as pd
+
     with open(gold_links_json_path, 'r') as file:
         gold_data = json.load(file)
     gold_columns_dict = {entry["question_id"]: {table.lower(): [col.lower().strip() for col in columns] for table, columns in entry["columns"].items()} for entry in gold_data}
@@ -171,12 +174,11 @@ def analyze_linked_columns(gold_links_json_path: str, linked_columns_json_path:
     print(f"Average Extra Columns per Question: {extra_columns_count / total_questions:.2f}")
     print("Failed in questions", number_of_questions_with_too_little_columns)
 
-# Example usage
-analyze_linked_columns(
-    gold_links_json_path='../../db_preprocessing/dev_gold_links.json',
-    linked_columns_json_path='../../output/linked_columns/column_links_results_conservative_top_k_15.json',
-    output_csv_path="column_analysis.csv"
-)
-
+if __name__ == '__main__':
+    analyze_linked_columns(
+        gold_links_json_path='../../db_preprocessing/dev_gold_links.json',
+        linked_columns_json_path='../../output/linked_columns/column_links_results_conservative_top_k_15.json',
+        output_csv_path="column_analysis.csv"
+    )
 
-analyze_linked_tables()
+    analyze_linked_tables()
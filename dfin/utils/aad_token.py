@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+if TYPE_CHECKING:
+    from azure.core.credentials import AccessToken
+    from azure.identity import ClientSecretCredential
+
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+# Tokens are refreshed this many seconds before expires_on
+DEFAULT_REFRESH_MARGIN_SECONDS = 300
+# Wait before trying again after a failed background refresh
+REFRESH_RETRY_SECONDS = 30
+
+
+class AADTokenProvider:
+    """
+    Process-wide Azure AD token source shared by every thread and event loop.
+
+    The ClientSecretCredential is built once. Tokens are cached until refresh_margin seconds before their
+    expires_on, and concurrent callers needing a refresh wait on a single request instead of each sending one.
+    With start_background_refresh, a daemon thread renews the token before it expires so callers never block.
+    """
+
+    def __init__(self, tenant_id: Optional[str], client_id: Optional[str], client_secret: Optional[str],
+                 scope: str = COGNITIVE_SERVICES_SCOPE, refresh_margin: float = DEFAULT_REFRESH_MARGIN_SECONDS):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self._credential: Optional["ClientSecretCredential"] = None
+        self._token: Optional["AccessToken"] = None
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[["AccessToken"], None]] = []
+        self._refresher: Optional[threading.Thread] = None
+        self.refreshes = 0
+
+    def _get_credential(self) -> "ClientSecretCredential":
+        if self._credential is None:
+            # azure.identity is slow to import, only load it once a token is needed
+            from azure.identity import ClientSecretCredential
+            self._credential = ClientSecretCredential(self.tenant_id, self.client_id, self.client_secret)
+        return self._credential
+
+    def _is_fresh(self, token: Optional["AccessToken"]) -> bool:
+        return token is not None and token.expires_on - time.time() > self.refresh_margin
+
+    def _refresh(self) -> "AccessToken":
+        # Called with the lock held
+        token = self._get_credential().get_token(self.scope)
+        self._token = token
+        self.refreshes += 1
+        for listener in self._listeners:
+            listener(token)
+        return token
+
+    def get_token(self) -> "AccessToken":
+        token = self._token
+        if self._is_fresh(token):
+            return token
+        # A token inside the refresh margin is still valid, keep using it while another thread renews it
+        still_valid = token is not None and token.expires_on > time.time() + 30
+        if not self._lock.acquire(blocking=not still_valid):
+            return token
+        try:
+            # Another thread may have refreshed while this one waited for the lock
+            if self._is_fresh(self._token):
+                return self._token
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def subscribe(self, listener: Callable[["AccessToken"], None]):
+        """Calls listener with every new token, e.g. to update clients holding the key themselves."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def start_background_refresh(self):
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="aad-token-refresh", daemon=True)
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            token = self._token
+            if token is not None:
+                time.sleep(max(token.expires_on - time.time() - self.refresh_margin, 1))
+            try:
+                with self._lock:
+                    if not self._is_fresh(self._token):
+                        self._refresh()
+            except Exception as e:
+                print(f"AAD token refresh failed: {e}, retrying in {REFRESH_RETRY_SECONDS}s")
+                time.sleep(REFRESH_RETRY_SECONDS)
+
+
+class StaticTokenProvider(AADTokenProvider):
+    """Serves a fixed token that never expires, for local endpoints such as openai_stub_server.py."""
+
+    def __init__(self, token: str):
+        from azure.core.credentials import AccessToken
+
+        super().__init__(None, None, None)
+        self._token = AccessToken(token, 2 ** 62)
+
+    def get_token(self) -> "AccessToken":
+        return self._token
+
+    def start_background_refresh(self):
+        pass
+
+
+if os.getenv("AZ_OAI_STATIC_TOKEN"):
+    TOKEN_PROVIDER = StaticTokenProvider(os.getenv("AZ_OAI_STATIC_TOKEN"))
+else:
+    TOKEN_PROVIDER = AADTokenProvider(
+        os.getenv("AZ_TENANT_ID"),
+        os.getenv("AZ_SP_CLIENT_ID"),
+        os.getenv("AZ_SP_CLIENT_SECRET"),
+    )
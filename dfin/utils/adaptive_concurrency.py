@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Type
+
+from .retry_policy import get_status
+
+
+DEFAULT_INITIAL_LIMIT = int(os.getenv("DFIN_INITIAL_CONCURRENCY", 4))
+DEFAULT_MAX_LIMIT = int(os.getenv("DFIN_MAX_CONCURRENCY", 32))
+DEFAULT_STATUS_INTERVAL_SECONDS = float(os.getenv("DFIN_STATUS_INTERVAL_SECONDS", 30))
+# Seconds between polls of an asyncio waiter, the slots are shared with threads so there is no loop-bound wakeup
+ASYNC_POLL_SECONDS = 0.01
+
+OVERLOAD_STATUSES = {408, 429, 504}
+
+
+@lru_cache(maxsize=None)
+def overload_exceptions() -> Tuple[Type[BaseException], ...]:
+    import openai.error
+    import requests
+
+    return openai.error.RateLimitError, openai.error.Timeout, requests.exceptions.Timeout, TimeoutError
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Throttling and timeouts, the signals that the endpoint is congested."""
+    status = get_status(error)
+    if status is not None:
+        return status in OVERLOAD_STATUSES
+    return isinstance(error, overload_exceptions())
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on the in-flight calls to one deployment.
+
+    Every healthy completion (no error, latency within latency_tolerance times the recent p50) adds 1 / limit,
+    i.e. about one slot per full window of calls. A throttle or timeout halves the limit, at most once per
+    window, since all the calls already in flight are likely to fail together. Other errors leave it unchanged.
+    Slots are taken by threads (slot) and coroutines (aslot) alike.
+    """
+
+    def __init__(self, name: str, initial_limit: int = DEFAULT_INITIAL_LIMIT, min_limit: int = 1,
+                 max_limit: int = DEFAULT_MAX_LIMIT, decrease_factor: float = 0.5, latency_tolerance: float = 2.0,
+                 window: int = 200):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)  # True for a throttled call
+        # The first throttle always decreases
+        self._calls_since_decrease = window
+        self.calls = 0
+        self.throttled = 0
+        self.decreases = 0
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._condition:
+            while not self._try_acquire():
+                self._condition.wait()
+
+    async def aacquire(self):
+        while True:
+            with self._condition:
+                if self._try_acquire():
+                    return
+            await asyncio.sleep(ASYNC_POLL_SECONDS)
+
+    def release(self, latency: float, error: Optional[BaseException] = None):
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            self._calls_since_decrease += 1
+            overloaded = error is not None and is_overload_error(error)
+            self._outcomes.append(overloaded)
+            if overloaded:
+                self.throttled += 1
+                if self._calls_since_decrease >= self.limit:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._calls_since_decrease = 0
+                    self.decreases += 1
+            elif error is None:
+                p50 = percentile(list(self._latencies), 0.5)
+                if p50 is None or latency <= self.latency_tolerance * p50:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._latencies.append(latency)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        started_at = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.release(time.monotonic() - started_at, e)
+            raise
+        self.release(time.monotonic() - started_at)
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        started_at = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.release(time.monotonic() - started_at, e)
+            raise
+        self.release(time.monotonic() - started_at)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        with self._condition:
+            latencies = list(self._latencies)
+            outcomes = list(self._outcomes)
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "throttle_rate": sum(outcomes) / len(outcomes) if outcomes else 0.0,
+            }
+
+    def format_status(self) -> str:
+        stats = self.stats()
+        latency = "-" if stats["p50"] is None else f"{stats['p50']:.1f}s/{stats['p95']:.1f}s"
+        return (f"{self.name} limit={stats['limit']} in_flight={stats['in_flight']} calls={stats['calls']} "
+                f"p50/p95={latency} throttled={stats['throttle_rate']:.1%}")
+
+
+class StatusReporter:
+    """Prints the status of the given limiters every interval seconds from a daemon thread while in use."""
+
+    def __init__(self, limiters: List[AdaptiveConcurrencyLimiter],
+                 interval_seconds: float = DEFAULT_STATUS_INTERVAL_SECONDS):
+        self.limiters = limiters
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def print_status(self):
+        active = [limiter.format_status() for limiter in self.limiters if limiter.calls or limiter.in_flight]
+        if active:
+            print("[status] " + " | ".join(active))
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.print_status()
+
+    def start(self) -> "StatusReporter":
+        if self.interval_seconds > 0 and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="dfin-status", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the reporting thread and prints a final status line."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.print_status()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,9 +1,22 @@
-import openai
+import json
 import os
 import time
+from array import array
 from functools import wraps
-from azure.identity import ClientSecretCredential
-from langchain.chat_models import AzureChatOpenAI
+from typing import Dict, Iterator, List, Optional
+
+import requests
+
+from .aad_token import TOKEN_PROVIDER
+from .adaptive_concurrency import AdaptiveConcurrencyLimiter, StatusReporter
+from .completion_cache import COMPLETION_CACHE
+from .disk_cache import SQLiteCache, hash_key
+from .http_sessions import SESSION_POOL, SessionPool, AzureOpenAIHTTPError, deployment_url, auth_headers
+from .rate_limiter import RateLimiter, estimate_chat_tokens, estimate_embedding_tokens, \
+    DEFAULT_COMPLETION_TOKENS_ESTIMATE
+from .retry_policy import RetryPolicy, DEFAULT_DEADLINE_SECONDS
+from .tokens import count_tokens
+from .usage_metrics import USAGE_METRICS, EMBEDDING_STAGE
 
 
 AZ_OAI_API_BASE_GPT_3 = os.getenv("AZ_OAI_API_BASE_GPT_3")
@@ -13,117 +26,331 @@ AZ_OAI_DEPLOYMENT_ID_GPT_3 = os.getenv("AZ_OAI_DEPLOYMENT_ID_GPT_3")
 AZ_OAI_DEPLOYMENT_ID_GPT_4 = os.getenv("AZ_OAI_DEPLOYMENT_ID_GPT_4")
 AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k = os.getenv("AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k")
 AZ_OAI_DEPLOYMENT_ID_ADA_2 = os.getenv("AZ_OAI_DEPLOYMENT_ID_ADA_2")
+AZ_OAI_API_VERSION = "2023-05-15"
+
+# Per request budget of the embeddings endpoint
+AZ_OAI_EMBEDDING_MAX_INPUTS = int(os.getenv("AZ_OAI_EMBEDDING_MAX_INPUTS", 16))
+AZ_OAI_EMBEDDING_MAX_TOKENS = int(os.getenv("AZ_OAI_EMBEDDING_MAX_TOKENS", 8191))
+
+# Client-side quotas per deployment (requests and tokens per minute), 0 or unset means unlimited
+AZ_OAI_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("AZ_OAI_COMPLETION_TOKENS_ESTIMATE", DEFAULT_COMPLETION_TOKENS_ESTIMATE))
+RATE_LIMITER_GPT_4 = RateLimiter(
+    "gpt-4", rpm=float(os.getenv("AZ_OAI_RPM_GPT_4", 0)), tpm=float(os.getenv("AZ_OAI_TPM_GPT_4", 0)))
+RATE_LIMITER_GPT_4_32_k = RateLimiter(
+    "gpt-4-32k", rpm=float(os.getenv("AZ_OAI_RPM_GPT_4_32_k", 0)), tpm=float(os.getenv("AZ_OAI_TPM_GPT_4_32_k", 0)))
+RATE_LIMITER_ADA_2 = RateLimiter(
+    "ada-2", rpm=float(os.getenv("AZ_OAI_RPM_ADA_2", 0)), tpm=float(os.getenv("AZ_OAI_TPM_ADA_2", 0)))
+RATE_LIMITERS = [RATE_LIMITER_GPT_4, RATE_LIMITER_GPT_4_32_k, RATE_LIMITER_ADA_2]
 
+# Adaptive (AIMD) limits on the in-flight calls per deployment
+CONCURRENCY_GPT_4 = AdaptiveConcurrencyLimiter("gpt-4")
+CONCURRENCY_GPT_4_32_k = AdaptiveConcurrencyLimiter("gpt-4-32k")
+CONCURRENCY_ADA_2 = AdaptiveConcurrencyLimiter("ada-2")
+CONCURRENCY_LIMITERS = [CONCURRENCY_GPT_4, CONCURRENCY_GPT_4_32_k, CONCURRENCY_ADA_2]
 
-openai.api_type = "azuread"
-openai.api_base = AZ_OAI_API_BASE_GPT_3
-openai.api_version = "2023-05-15"
+# Content addressed cache of all embeddings, shared by every run on this machine
+EMBEDDING_CACHE_READ_WRITE = "read_write"
+EMBEDDING_CACHE_OFFLINE = "offline"  # never call the API, fail on a cache miss
+EMBEDDING_CACHE_DISABLED = "disabled"
+EMBEDDING_CACHE_MODES = [EMBEDDING_CACHE_READ_WRITE, EMBEDDING_CACHE_OFFLINE, EMBEDDING_CACHE_DISABLED]
 
-os.environ["OPENAI_API_VERSION"] = "2023-05-15"
-os.environ["OPENAI_API_BASE"] = AZ_OAI_API_BASE_GPT_3
+EMBEDDING_CACHE_MODE = os.getenv("DFIN_EMBEDDING_CACHE_MODE", EMBEDDING_CACHE_READ_WRITE)
+EMBEDDING_CACHE = SQLiteCache(
+    path=os.getenv("DFIN_EMBEDDING_CACHE_PATH", "output/cache/embeddings.sqlite"),
+    max_bytes=int(float(os.getenv("DFIN_EMBEDDING_CACHE_MB", 2048)) * 2 ** 20),
+)
 
-# Global variables to store the token and its expiration time
-# Global variables to store the token and its expiration time
-current_token = None
-token_expiration_time = None
+
+def configure_openai_module():
+    """
+    Points the openai module defaults (and the environment LangChain reads them from) at Azure AD and the GPT-3
+    endpoint. Called when a LangChain LLM is built rather than on import, the clients here pass everything per call.
+    """
+    import openai
+
+    openai.api_type = "azuread"
+    openai.api_version = AZ_OAI_API_VERSION
+    os.environ["OPENAI_API_VERSION"] = AZ_OAI_API_VERSION
+    if AZ_OAI_API_BASE_GPT_3:
+        openai.api_base = AZ_OAI_API_BASE_GPT_3
+        os.environ["OPENAI_API_BASE"] = AZ_OAI_API_BASE_GPT_3
 
 
 def get_token():
-    global current_token, token_expiration_time
-
-    # Check if the token is about to expire (or has already expired)
-    if current_token is None or token_expiration_time is None or (token_expiration_time - time.time()) < 60:
-        credential = ClientSecretCredential(
-            os.getenv("AZ_TENANT_ID"),
-            os.getenv("AZ_SP_CLIENT_ID"),
-            os.getenv("AZ_SP_CLIENT_SECRET"),
-        )
-        current_token = credential.get_token("https://cognitiveservices.azure.com/.default")
+    """Current AAD token of the shared provider, refreshed before it expires."""
+    return TOKEN_PROVIDER.get_token()
+
+
+class AzureOpenAIClient:
+    """
+    Synchronous Azure OpenAI client over the pooled keep-alive sessions, without the openai module globals.
+
+    Endpoint, deployment and key are given per call, so one client serves every deployment and thread.
+    """
+
+    def __init__(self, api_type: str = "azuread", api_version: str = AZ_OAI_API_VERSION,
+                 sessions: SessionPool = SESSION_POOL):
+        self.api_type = api_type
+        self.api_version = api_version
+        self.sessions = sessions
+
+    def send(self, api_base: str, api_key: str, deployment_id: str, operation: str, payload: dict,
+             stream: bool = False) -> requests.Response:
+        response = self.sessions.post(deployment_url(api_base, deployment_id, operation),
+                                      params={"api-version": self.api_version}, json=payload,
+                                      headers=auth_headers(self.api_type, api_key), stream=stream)
+        if response.status_code >= 400:
+            raise AzureOpenAIHTTPError(response.status_code, response.text, dict(response.headers))
+        return response
+
+    def post(self, api_base: str, api_key: str, deployment_id: str, operation: str, payload: dict) -> dict:
+        return self.send(api_base, api_key, deployment_id, operation, payload).json()
+
+    def open_chat_stream(self, api_base: str, api_key: str, deployment_id: str, payload: dict) -> requests.Response:
+        """Sends a streamed chat completion request, HTTP errors are raised here, before any chunk is read."""
+        return self.send(api_base, api_key, deployment_id, "chat/completions", {**payload, "stream": True},
+                         stream=True)
 
-        # Update the expiration time
-        # Assuming the token lasts for 1 hour, adjust as necessary
-        token_expiration_time = time.time() + 3600
+    @staticmethod
+    def iter_chat_stream(response: requests.Response) -> Iterator[dict]:
+        """
+        Chunks of a streamed chat completion, read from its server-sent events as they arrive.
 
-    return current_token
+        Closing the iterator early closes the response, so the rest of the completion is never read and the
+        connection is dropped instead of going back to the pool.
+        """
+        try:
+            # Event streams are UTF-8, requests would decode them as ISO-8859-1 when no charset is sent
+            for raw_line in response.iter_lines():
+                line = raw_line.decode("utf-8")
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                yield json.loads(data)
+        finally:
+            response.close()
 
+    def chat_completion(self, messages: List[Dict[str, str]], api_base: str, api_key: str,
+                        deployment_id: str, temperature: float = 0, **params) -> str:
+        response = self.post(api_base, api_key, deployment_id, "chat/completions",
+                             {"messages": messages, "temperature": temperature, **params})
+        return response["choices"][0]["message"]["content"]
 
-def retry(max_retries=5, delay=3):
-    """A decorator to retry function execution in case of errors."""
+    def embeddings(self, docs: List[str], api_base: str, api_key: str, deployment_id: str) -> List[List[float]]:
+        response = self.post(api_base, api_key, deployment_id, "embeddings", {"input": docs})
+        # The service does not guarantee the order of the results
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+
+AZURE_OPENAI_CLIENT = AzureOpenAIClient()
+
+
+def retry(max_retries=5, deployment=None, deadline=DEFAULT_DEADLINE_SECONDS):
+    """
+    A decorator to retry function execution on retryable errors (throttling, timeouts, transient failures).
+
+    Uses exponential backoff with jitter or the server's Retry-After, and gives up once the deadline would be
+    exceeded. Fatal errors are raised right away. Retries are counted per deployment in RETRY_STATS.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            for _ in range(max_retries):
+            policy = RetryPolicy(max_retries=max_retries, deadline=deadline, deployment=deployment)
+            started_at = time.monotonic()
+            attempt = 0
+            while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
-                    print(f'Error: {e}, retrying...')
+                    delay = policy.next_delay(e, attempt, started_at)
+                    if delay is None:
+                        raise
                     time.sleep(delay)
-            return func(*args, **kwargs)
+                    attempt += 1
         return wrapper
     return decorator
 
 
-@retry(max_retries=5, delay=3)
+class EmbeddingCacheMissError(Exception):
+    pass
+
+
+def set_embedding_cache_mode(mode: str):
+    global EMBEDDING_CACHE_MODE
+    if mode not in EMBEDDING_CACHE_MODES:
+        raise Exception(f"Embedding cache mode is missing use the following: {EMBEDDING_CACHE_MODES}")
+    EMBEDDING_CACHE_MODE = mode
+
+
 def get_embedding(doc, model="gpt-3.5-turbo"):
-    openai.api_base = AZ_OAI_API_BASE_GPT_3
-    openai.api_key = get_token().token
+    return get_embeddings([doc])[0]
 
-    response = openai.Embedding.create(
-        input=doc,
-        # model=model,
-        deployment_id=AZ_OAI_DEPLOYMENT_ID_ADA_2
-    )
-    return response['data'][0]['embedding']
+
+def batch_embedding_inputs(
+        docs: List[str],
+        max_inputs: int = AZ_OAI_EMBEDDING_MAX_INPUTS,
+        max_tokens: int = AZ_OAI_EMBEDDING_MAX_TOKENS
+) -> List[List[int]]:
+    """Splits the inputs (by position) into consecutive batches within the per request budget."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for index, doc in enumerate(docs):
+        doc_tokens = count_tokens(doc)
+        if batch and (len(batch) >= max_inputs or batch_tokens + doc_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(index)
+        batch_tokens += doc_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@retry(max_retries=5, deployment=AZ_OAI_DEPLOYMENT_ID_ADA_2)
+def _get_embeddings_batch(docs: List[str]) -> List[List[float]]:
+    tokens = estimate_embedding_tokens(docs)
+    RATE_LIMITER_ADA_2.acquire(tokens)
+    api_key = get_token().token
+    started_at = time.monotonic()
+    with CONCURRENCY_ADA_2.slot():
+        embeddings = AZURE_OPENAI_CLIENT.embeddings(docs, AZ_OAI_API_BASE_GPT_3, api_key, AZ_OAI_DEPLOYMENT_ID_ADA_2)
+    USAGE_METRICS.record("ada-2", tokens, 0, time.monotonic() - started_at, stage=EMBEDDING_STAGE)
+    return embeddings
 
 
-@retry(max_retries=5, delay=3)
-def get_completion_4(prompt, model="gpt-4"):
-    openai.api_base = AZ_OAI_API_BASE_GPT_4
-    openai.api_key = get_token().token
+def _get_embeddings_uncached(docs: List[str], max_inputs: int, max_tokens: int) -> List[List[float]]:
+    embeddings = []
+    for batch in batch_embedding_inputs(docs, max_inputs, max_tokens):
+        embeddings.extend(_get_embeddings_batch([docs[index] for index in batch]))
+    return embeddings
+
+
+def _embedding_cache_key(doc: str) -> str:
+    return hash_key(AZ_OAI_DEPLOYMENT_ID_ADA_2 or "", doc)
+
+
+def _decode_embedding(value: bytes) -> List[float]:
+    embedding = array('d')
+    embedding.frombytes(value)
+    return embedding.tolist()
+
+
+def get_embeddings(
+        docs: List[str],
+        max_inputs: int = AZ_OAI_EMBEDDING_MAX_INPUTS,
+        max_tokens: int = AZ_OAI_EMBEDDING_MAX_TOKENS
+) -> List[List[float]]:
+    """
+    Embeds many inputs with as few requests as the budget allows, keeping the input order.
+
+    Inputs already embedded by the same deployment are served from EMBEDDING_CACHE.
+    """
+    if EMBEDDING_CACHE_MODE == EMBEDDING_CACHE_DISABLED:
+        return _get_embeddings_uncached(docs, max_inputs, max_tokens)
+
+    keys, cached, missing = split_cached_embeddings(docs)
+    embeddings = _get_embeddings_uncached(list(missing.values()), max_inputs, max_tokens) if missing else []
+    return merge_computed_embeddings(keys, cached, missing, embeddings)
+
+
+def split_cached_embeddings(docs: List[str]):
+    """Returns the cache keys of the inputs, the cached (encoded) embeddings and the missing inputs by key."""
+    keys = [_embedding_cache_key(doc) for doc in docs]
+    cached = EMBEDDING_CACHE.get_many(keys)
+
+    missing = {key: doc for key, doc in zip(keys, docs) if key not in cached}
+    if missing and EMBEDDING_CACHE_MODE == EMBEDDING_CACHE_OFFLINE:
+        raise EmbeddingCacheMissError(f"{len(missing)} of {len(docs)} embeddings are not cached (offline mode)")
+    return keys, cached, missing
+
+
+def merge_computed_embeddings(keys, cached, missing, embeddings) -> List[List[float]]:
+    """Stores the embeddings computed for the missing inputs and returns all embeddings in input order."""
+    computed = {key: array('d', embedding).tobytes() for key, embedding in zip(missing, embeddings)}
+    EMBEDDING_CACHE.set_many(computed)
+    cached.update(computed)
+    return [_decode_embedding(cached[key]) for key in keys]
+
+
+def record_chat_usage(model: str, messages: List[Dict[str, str]], completion: str, started_at: float):
+    """Counts the tokens of a completed chat call locally and records them with its latency."""
+    USAGE_METRICS.record(model, estimate_chat_tokens(messages, None), count_tokens(completion),
+                         time.monotonic() - started_at)
+
+
+@retry(max_retries=5, deployment=AZ_OAI_DEPLOYMENT_ID_GPT_4)
+def _chat_completion_4(messages, model):
+    RATE_LIMITER_GPT_4.acquire(estimate_chat_tokens(messages, AZ_OAI_COMPLETION_TOKENS_ESTIMATE))
+    api_key = get_token().token
+    started_at = time.monotonic()
+    with CONCURRENCY_GPT_4.slot():
+        completion = AZURE_OPENAI_CLIENT.chat_completion(
+            messages,
+            AZ_OAI_API_BASE_GPT_4,
+            api_key,
+            AZ_OAI_DEPLOYMENT_ID_GPT_4,
+            temperature=0, # this is the degree of randomness of the model's output
+            model=model
+        )
+    record_chat_usage("gpt-4", messages, completion, started_at)
+    return completion
+
+
+def get_completion_4(prompt, model="gpt-4", prompt_version=""):
     messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=0, # this is the degree of randomness of the model's output
-        deployment_id=AZ_OAI_DEPLOYMENT_ID_GPT_4
+    return COMPLETION_CACHE.get_or_compute(
+        messages,
+        AZ_OAI_DEPLOYMENT_ID_GPT_4,
+        {"model": model, "temperature": 0},
+        lambda: _chat_completion_4(messages, model),
+        prompt_version
     )
-    return response.choices[0].message["content"]
 
 
-@retry(max_retries=1, delay=3)
-def get_completion_4_32(prompt):
-    openai.api_base = AZ_OAI_API_BASE_GPT_4_32_k
-    openai.api_key = get_token().token
+@retry(max_retries=1, deployment=AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k)
+def _chat_completion_4_32(messages):
+    RATE_LIMITER_GPT_4_32_k.acquire(estimate_chat_tokens(messages, AZ_OAI_COMPLETION_TOKENS_ESTIMATE))
+    api_key = get_token().token
+    started_at = time.monotonic()
+    with CONCURRENCY_GPT_4_32_k.slot():
+        completion = AZURE_OPENAI_CLIENT.chat_completion(
+            messages, AZ_OAI_API_BASE_GPT_4_32_k, api_key, AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k, temperature=0)
+    record_chat_usage("gpt-4-32k", messages, completion, started_at)
+    return completion
+
+
+def get_completion_4_32(prompt, prompt_version=""):
     messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
-        messages=messages,
-        temperature=0,
-        deployment_id=AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k
+    return COMPLETION_CACHE.get_or_compute(
+        messages,
+        AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k,
+        {"temperature": 0},
+        lambda: _chat_completion_4_32(messages),
+        prompt_version
     )
-    return response.choices[0].message["content"]
 
 
 def get_langchain_llm_4():
-    openai.api_base = AZ_OAI_API_BASE_GPT_4
-    os.environ["OPENAI_API_BASE"] = AZ_OAI_API_BASE_GPT_4
-    os.environ["OPENAI_API_KEY"] = get_token().token
-    return AzureChatOpenAI(
-        openai_api_base=AZ_OAI_API_BASE_GPT_4,
-        openai_api_version="2023-05-15",
-        deployment_name=AZ_OAI_DEPLOYMENT_ID_GPT_4,
-        openai_api_type="azuread",
-    )
+    # LangChain is slow to import, it is only loaded once an LLM is built
+    from .langchain_llm import get_langchain_llm
+    return get_langchain_llm(AZ_OAI_API_BASE_GPT_4, AZ_OAI_DEPLOYMENT_ID_GPT_4, RATE_LIMITER_GPT_4, CONCURRENCY_GPT_4,
+                             "gpt-4")
 
 
 def get_langchain_llm_4_32_k():
-    openai.api_base = AZ_OAI_API_BASE_GPT_4_32_k
-    os.environ["OPENAI_API_BASE"] = AZ_OAI_API_BASE_GPT_4_32_k
-    os.environ["OPENAI_API_KEY"] = get_token().token
-    return AzureChatOpenAI(
-        openai_api_base=AZ_OAI_API_BASE_GPT_4_32_k,
-        openai_api_version="2023-05-15",
-        deployment_name=AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k,
-        openai_api_type="azuread",
-    )
+    from .langchain_llm import get_langchain_llm
+    return get_langchain_llm(AZ_OAI_API_BASE_GPT_4_32_k, AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k, RATE_LIMITER_GPT_4_32_k,
+                             CONCURRENCY_GPT_4_32_k, "gpt-4-32k")
+
+
+def format_rate_limiter_stats() -> str:
+    return "Rate limiters: " + "; ".join(limiter.format_stats() for limiter in RATE_LIMITERS if limiter.requests)
 
 
+def status_reporter(interval_seconds: Optional[float] = None) -> StatusReporter:
+    """Context manager printing the concurrency limit, latency and throttle rate of each deployment periodically."""
+    if interval_seconds is None:
+        return StatusReporter(CONCURRENCY_LIMITERS)
+    return StatusReporter(CONCURRENCY_LIMITERS, interval_seconds)
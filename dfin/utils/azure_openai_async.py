@@ -0,0 +1,216 @@
+import asyncio
+import time
+from functools import wraps
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from . import azure_openai
+from .azure_openai import AZ_OAI_API_BASE_GPT_3, AZ_OAI_API_BASE_GPT_4, AZ_OAI_API_BASE_GPT_4_32_k, \
+    AZ_OAI_DEPLOYMENT_ID_GPT_4, AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k, AZ_OAI_DEPLOYMENT_ID_ADA_2, AZ_OAI_API_VERSION, \
+    AZ_OAI_EMBEDDING_MAX_INPUTS, AZ_OAI_EMBEDDING_MAX_TOKENS, batch_embedding_inputs, split_cached_embeddings, \
+    merge_computed_embeddings, get_token, RATE_LIMITER_GPT_4, RATE_LIMITER_GPT_4_32_k, RATE_LIMITER_ADA_2, \
+    AZ_OAI_COMPLETION_TOKENS_ESTIMATE, CONCURRENCY_GPT_4, CONCURRENCY_GPT_4_32_k, CONCURRENCY_ADA_2, record_chat_usage
+from .adaptive_concurrency import AdaptiveConcurrencyLimiter
+from .completion_cache import COMPLETION_CACHE
+from .http_sessions import ASYNC_SESSION_POOL, AsyncSessionPool, AzureOpenAIHTTPError, deployment_url, auth_headers, \
+    get_endpoint
+from .rate_limiter import RateLimiter, estimate_chat_tokens, estimate_embedding_tokens
+from .retry_policy import RetryPolicy, DEFAULT_DEADLINE_SECONDS
+from .usage_metrics import USAGE_METRICS, EMBEDDING_STAGE
+
+
+DEFAULT_MAX_IN_FLIGHT = 16
+DEFAULT_TIMEOUT_SECONDS = 120
+
+
+def async_retry(max_retries=5, deployment=None, deadline=DEFAULT_DEADLINE_SECONDS):
+    """Asyncio counterpart of azure_openai.retry, aiohttp connection errors are retryable too."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            policy = RetryPolicy(max_retries=max_retries, deadline=deadline, deployment=deployment,
+                                 extra_retryable=(aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+            started_at = time.monotonic()
+            attempt = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    delay = policy.next_delay(e, attempt, started_at)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        return wrapper
+    return decorator
+
+
+class AsyncAzureOpenAIClient:
+    """
+    Asyncio Azure OpenAI client without global state.
+
+    Endpoint, deployment and key are given per call, and at most max_in_flight requests are sent at once.
+    Requests go through the pooled keep-alive sessions of the running event loop (ASYNC_SESSION_POOL).
+    """
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+                 api_type: str = "azuread", api_version: str = AZ_OAI_API_VERSION,
+                 sessions: AsyncSessionPool = ASYNC_SESSION_POOL):
+        self.max_in_flight = max_in_flight
+        self.timeout_seconds = timeout_seconds
+        self.api_type = api_type
+        self.api_version = api_version
+        self.sessions = sessions
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.sessions.close()
+
+    async def _post(self, api_base: str, api_key: str, deployment_id: str, operation: str, payload: dict) -> dict:
+        url = deployment_url(api_base, deployment_id, operation)
+        async with self._semaphore:
+            async with self.sessions.get(get_endpoint(url)).post(
+                    url, params={"api-version": self.api_version}, json=payload,
+                    headers=auth_headers(self.api_type, api_key),
+                    timeout=aiohttp.ClientTimeout(total=self.timeout_seconds)) as response:
+                if response.status >= 400:
+                    raise AzureOpenAIHTTPError(response.status, await response.text(), dict(response.headers))
+                return await response.json()
+
+    async def chat_completion(self, messages: List[Dict[str, str]], api_base: str, api_key: str,
+                              deployment_id: str, temperature: float = 0, **params) -> str:
+        response = await self._post(api_base, api_key, deployment_id, "chat/completions",
+                                    {"messages": messages, "temperature": temperature, **params})
+        return response["choices"][0]["message"]["content"]
+
+    async def embeddings(self, docs: List[str], api_base: str, api_key: str, deployment_id: str) -> List[List[float]]:
+        response = await self._post(api_base, api_key, deployment_id, "embeddings", {"input": docs})
+        # The service does not guarantee the order of the results
+        return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+
+_default_clients: Dict[asyncio.AbstractEventLoop, AsyncAzureOpenAIClient] = {}
+
+
+def get_default_async_client(max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> AsyncAzureOpenAIClient:
+    """Client shared by the module level functions, one per event loop (created on first use)."""
+    loop = asyncio.get_running_loop()
+    client = _default_clients.get(loop)
+    if client is None:
+        client = _default_clients[loop] = AsyncAzureOpenAIClient(max_in_flight)
+    return client
+
+
+async def close_default_async_client():
+    client = _default_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def _get_api_key() -> str:
+    # The token is cached, a refresh blocks so it runs in a worker thread
+    return (await asyncio.to_thread(get_token)).token
+
+
+@async_retry(max_retries=5, deployment=AZ_OAI_DEPLOYMENT_ID_ADA_2)
+async def _aget_embeddings_batch(docs: List[str], client: AsyncAzureOpenAIClient) -> List[List[float]]:
+    tokens = estimate_embedding_tokens(docs)
+    await RATE_LIMITER_ADA_2.aacquire(tokens)
+    api_key = await _get_api_key()
+    started_at = time.monotonic()
+    async with CONCURRENCY_ADA_2.aslot():
+        embeddings = await client.embeddings(docs, AZ_OAI_API_BASE_GPT_3, api_key, AZ_OAI_DEPLOYMENT_ID_ADA_2)
+    USAGE_METRICS.record("ada-2", tokens, 0, time.monotonic() - started_at, stage=EMBEDDING_STAGE)
+    return embeddings
+
+
+async def aget_embeddings(
+        docs: List[str],
+        max_inputs: int = AZ_OAI_EMBEDDING_MAX_INPUTS,
+        max_tokens: int = AZ_OAI_EMBEDDING_MAX_TOKENS,
+        client: Optional[AsyncAzureOpenAIClient] = None
+) -> List[List[float]]:
+    """Async get_embeddings, the batches of the missing inputs are sent concurrently."""
+    client = client or get_default_async_client()
+
+    async def embed(missing_docs: List[str]) -> List[List[float]]:
+        batches = batch_embedding_inputs(missing_docs, max_inputs, max_tokens)
+        results = await asyncio.gather(*[
+            _aget_embeddings_batch([missing_docs[index] for index in batch], client) for batch in batches
+        ])
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+
+    if azure_openai.EMBEDDING_CACHE_MODE == azure_openai.EMBEDDING_CACHE_DISABLED:
+        return await embed(docs)
+
+    keys, cached, missing = await asyncio.to_thread(split_cached_embeddings, docs)
+    embeddings = await embed(list(missing.values())) if missing else []
+    return await asyncio.to_thread(merge_computed_embeddings, keys, cached, missing, embeddings)
+
+
+async def aget_embedding(doc: str, client: Optional[AsyncAzureOpenAIClient] = None) -> List[float]:
+    return (await aget_embeddings([doc], client=client))[0]
+
+
+async def _achat_completion(messages: List[Dict[str, str]], api_base: str, deployment_id: str,
+                            client: AsyncAzureOpenAIClient, rate_limiter: RateLimiter,
+                            concurrency_limiter: AdaptiveConcurrencyLimiter, usage_model: str,
+                            model: Optional[str] = None) -> str:
+    # Like the sync calls, model is only sent when given
+    params = {"model": model} if model is not None else {}
+    await rate_limiter.aacquire(estimate_chat_tokens(messages, AZ_OAI_COMPLETION_TOKENS_ESTIMATE))
+    api_key = await _get_api_key()
+    started_at = time.monotonic()
+    async with concurrency_limiter.aslot():
+        completion = await client.chat_completion(messages, api_base, api_key, deployment_id, temperature=0, **params)
+    record_chat_usage(usage_model, messages, completion, started_at)
+    return completion
+
+
+_achat_completion_4 = async_retry(max_retries=5, deployment=AZ_OAI_DEPLOYMENT_ID_GPT_4)(_achat_completion)
+_achat_completion_4_32 = async_retry(max_retries=1, deployment=AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k)(_achat_completion)
+
+
+async def _acached_completion(messages: List[Dict[str, str]], deployment_id: str, params: Dict,
+                              compute, prompt_version: str) -> str:
+    if not COMPLETION_CACHE.enabled:
+        return await compute()
+    key = COMPLETION_CACHE.key(messages, deployment_id, params, prompt_version)
+    completion = await asyncio.to_thread(COMPLETION_CACHE.get, key)
+    if completion is None:
+        completion = await compute()
+        await asyncio.to_thread(COMPLETION_CACHE.set, key, completion)
+    return completion
+
+
+async def aget_completion_4(prompt: str, model: str = "gpt-4", prompt_version: str = "",
+                            client: Optional[AsyncAzureOpenAIClient] = None) -> str:
+    client = client or get_default_async_client()
+    messages = [{"role": "user", "content": prompt}]
+    # Same cache key as the sync get_completion_4
+    return await _acached_completion(
+        messages, AZ_OAI_DEPLOYMENT_ID_GPT_4, {"model": model, "temperature": 0},
+        lambda: _achat_completion_4(messages, AZ_OAI_API_BASE_GPT_4, AZ_OAI_DEPLOYMENT_ID_GPT_4, client,
+                                    RATE_LIMITER_GPT_4, CONCURRENCY_GPT_4, "gpt-4", model=model),
+        prompt_version
+    )
+
+
+async def aget_completion_4_32(prompt: str, prompt_version: str = "",
+                               client: Optional[AsyncAzureOpenAIClient] = None) -> str:
+    client = client or get_default_async_client()
+    messages = [{"role": "user", "content": prompt}]
+    return await _acached_completion(
+        messages, AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k, {"temperature": 0},
+        lambda: _achat_completion_4_32(messages, AZ_OAI_API_BASE_GPT_4_32_k, AZ_OAI_DEPLOYMENT_ID_GPT_4_32_k, client,
+                                       RATE_LIMITER_GPT_4_32_k, CONCURRENCY_GPT_4_32_k,
+                                       "gpt-4-32k"),
+        prompt_version
+    )
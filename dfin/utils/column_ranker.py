@@ -0,0 +1,185 @@
+import os
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .embeddings_store import ColumnEmbeddingsStore, load_embeddings_store, quantize_matrix, dequantize_matrix, \
+    FLOAT32
+from .ivf_index import IVFIndex, get_ivf_index_path
+
+
+DEFAULT_N_PROBE = 8
+# Rows of a float16 or int8 matrix upcast to float32 at once while scoring, bounds the transient copy
+SCORE_CHUNK_ROWS = 1024
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Returns the indices of the top_k highest scores, best first.
+
+    Ties are broken by position, which matches `DataFrame.nlargest(keep='first')`.
+    """
+    if top_k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if scores.size > top_k:
+        partition = np.argpartition(-scores, top_k - 1)[:top_k]
+        # Keep every score tied with the k-th one so the positional tie break stays exact
+        candidates = np.flatnonzero(scores >= scores[partition].min())
+    else:
+        candidates = np.arange(scores.size)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:top_k]
+
+
+class ColumnRanker:
+    """
+    Ranks the columns of a single database by cosine similarity to a question embedding.
+
+    The column vectors are normalized once, so scoring every column of the database is a single
+    matrix-vector product; the top k of each table is then taken with argpartition.
+    When an IVF index was built for the database, rank_ann only scores the columns of the probed lists.
+
+    With a float16 or int8 precision only the quantized vectors stay resident, they are upcast to float32 a chunk
+    of rows at a time while scoring.
+    """
+
+    def __init__(self, store: ColumnEmbeddingsStore, ann_index: Optional[IVFIndex] = None, precision: str = FLOAT32):
+        matrix = store.dequantized_matrix()
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.precision = precision
+        self.vectors, self.scales = quantize_matrix(np.ascontiguousarray(matrix / norms, dtype=np.float32), precision)
+        self.column_names = list(store.column_names)
+
+        table_rows: Dict[str, List[int]] = {}
+        for row, table_name in enumerate(store.table_names):
+            table_rows.setdefault(table_name, []).append(row)
+        self.table_rows = {table_name: np.asarray(rows, dtype=np.int64) for table_name, rows in table_rows.items()}
+        self.ann_index = ann_index
+
+    @classmethod
+    def load(cls, embeddings_dir: str, db_id: str, precision: str = FLOAT32) -> "ColumnRanker":
+        store = load_embeddings_store(embeddings_dir, db_id)
+        ivf_index_path = get_ivf_index_path(embeddings_dir, db_id)
+        ann_index = IVFIndex.load(ivf_index_path) if os.path.exists(ivf_index_path) else None
+        if ann_index is not None and len(ann_index.assignments) != len(store.column_names):
+            # Built for another version of the shard, its rows would not match
+            print(f"Ignoring the ANN index of {db_id} ({len(ann_index.assignments)} columns, the embeddings have "
+                  f"{len(store.column_names)}), rebuild it")
+            ann_index = None
+        return cls(store, ann_index, precision)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def _float_vectors(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Normalized float32 vectors of all (or the given) columns, without a copy at float32 precision."""
+        if rows is None:
+            return dequantize_matrix(self.vectors, self.scales)
+        return dequantize_matrix(self.vectors[rows], self.scales[rows] if self.scales is not None else None)
+
+    def _float_chunks(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """(first row, normalized float32 vectors) over the matrix, by SCORE_CHUNK_ROWS rows unless already float32."""
+        if self.scales is None and self.vectors.dtype == np.float32:
+            yield 0, self.vectors
+            return
+        for start in range(0, len(self.vectors), SCORE_CHUNK_ROWS):
+            end = start + SCORE_CHUNK_ROWS
+            chunk = self.vectors[start:end].astype(np.float32)
+            if self.scales is not None:
+                chunk *= self.scales[start:end, None]
+            yield start, chunk
+
+    @staticmethod
+    def _normalize(question_embedding: Sequence[float]) -> np.ndarray:
+        question = np.asarray(question_embedding, dtype=np.float32)
+        norm = np.linalg.norm(question)
+        return question / norm if norm else question
+
+    def score(self, question_embedding: Sequence[float]) -> np.ndarray:
+        """Cosine similarity between the question and every column of the database."""
+        if self.vectors.size == 0:
+            return np.zeros(len(self.column_names), dtype=np.float32)
+        question = self._normalize(question_embedding)
+        scores = np.empty(len(self.column_names), dtype=np.float32)
+        for start, vectors in self._float_chunks():
+            scores[start:start + len(vectors)] = vectors @ question
+        return scores
+
+    def top_k_from_scores(self, scores: np.ndarray, table_names: Sequence[str], top_k: int) -> Dict[str, List[str]]:
+        top_k_columns = {}
+        for table_name in table_names:
+            rows = self.table_rows.get(table_name)
+            if rows is None:
+                top_k_columns[table_name] = []
+                continue
+            best = top_k_indices(scores[rows], top_k)
+            top_k_columns[table_name] = [self.column_names[row] for row in rows[best]]
+        return top_k_columns
+
+    def rank(self, question_embedding: Sequence[float], table_names: Sequence[str], top_k: int) -> Dict[str, List[str]]:
+        """Returns the top_k original column names of each of the given tables, best first."""
+        return self.top_k_from_scores(self.score(question_embedding), table_names, top_k)
+
+    def score_batch(self, question_embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+        """Cosine similarity between every question and every column, as a (questions x columns) matrix."""
+        questions = np.asarray(question_embeddings, dtype=np.float32).reshape(len(question_embeddings), -1)
+        if self.vectors.size == 0:
+            return np.zeros((len(questions), len(self.column_names)), dtype=np.float32)
+        norms = np.linalg.norm(questions, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        questions = questions / norms
+        scores = np.empty((len(questions), len(self.column_names)), dtype=np.float32)
+        for start, vectors in self._float_chunks():
+            scores[:, start:start + len(vectors)] = questions @ vectors.T
+        return scores
+
+    def rank_batch(
+        self,
+        question_embeddings: Sequence[Sequence[float]],
+        table_names_per_question: Sequence[Sequence[str]],
+        top_k: int
+    ) -> List[Dict[str, List[str]]]:
+        """Ranks many questions of this database with a single matrix product, one table filter per question."""
+        scores = self.score_batch(question_embeddings)
+        return [
+            self.top_k_from_scores(question_scores, table_names, top_k)
+            for question_scores, table_names in zip(scores, table_names_per_question)
+        ]
+
+    def rank_ann(
+        self,
+        question_embedding: Sequence[float],
+        table_names: Sequence[str],
+        top_k: int,
+        n_probe: int = DEFAULT_N_PROBE
+    ) -> Dict[str, List[str]]:
+        """
+        Approximate version of rank, only scoring the columns of the n_probe closest IVF lists.
+
+        A table with fewer than top_k probed columns is scored exactly, so no table comes back short.
+        Falls back to exact ranking when no index was built for the database.
+        """
+        if self.ann_index is None or self.vectors.size == 0:
+            return self.rank(question_embedding, table_names, top_k)
+
+        question = self._normalize(question_embedding)
+        probed_lists = self.ann_index.probe(question, n_probe)
+
+        top_k_columns = {}
+        for table_name in table_names:
+            rows = self.table_rows.get(table_name)
+            if rows is None:
+                top_k_columns[table_name] = []
+                continue
+            candidates = rows[probed_lists[self.ann_index.assignments[rows]]]
+            if len(candidates) < min(top_k, len(rows)):
+                candidates = rows
+            best = top_k_indices(self._float_vectors(candidates) @ question, top_k)
+            top_k_columns[table_name] = [self.column_names[row] for row in candidates[best]]
+        return top_k_columns
+
+    def build_ann_index(self, n_lists: Optional[int] = None) -> IVFIndex:
+        self.ann_index = IVFIndex.build(self._float_vectors(), n_lists=n_lists)
+        return self.ann_index
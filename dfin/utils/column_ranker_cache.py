@@ -0,0 +1,107 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .column_ranker import ColumnRanker
+from .embeddings_store import get_index_path, FLOAT32
+from .ivf_index import get_ivf_index_path
+
+
+DEFAULT_MAX_MB = 512
+
+# mtimes of the shard index and of the ANN index, None when missing
+Signature = Tuple[Optional[float], Optional[float]]
+
+
+class ColumnRankerCache:
+    """
+    Process-wide LRU cache of loaded per-database column rankers.
+
+    Entries are keyed by embeddings directory, db_id and precision and are reloaded when the mtime of the shard or of
+    its ANN index changes.
+    The total size of the cached matrices is capped at max_bytes; the most recently used entry is always kept.
+    Loads happen under the cache lock, so concurrent linking workers share a single copy per database.
+    """
+
+    def __init__(self, max_bytes: int, precision: str = FLOAT32):
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[Signature, ColumnRanker]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _get_mtime(path: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    @classmethod
+    def _get_signature(cls, embeddings_dir: str, db_id: str) -> Signature:
+        # The index is renamed in last whenever the shard is rewritten, the ANN index is built separately
+        return (cls._get_mtime(get_index_path(embeddings_dir, db_id)),
+                cls._get_mtime(get_ivf_index_path(embeddings_dir, db_id)))
+
+    @property
+    def current_bytes(self) -> int:
+        return sum(ranker.nbytes for _, ranker in self._entries.values())
+
+    def get(self, embeddings_dir: str, db_id: str) -> ColumnRanker:
+        precision = self.precision
+        key = (embeddings_dir, db_id, precision)
+        with self._lock:
+            signature = self._get_signature(embeddings_dir, db_id)
+            entry = self._entries.get(key)
+            if entry is not None and signature[0] is not None and entry[0] == signature:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+
+            self.misses += 1
+            ranker = ColumnRanker.load(embeddings_dir, db_id, precision)
+            # Loading may have converted a legacy CSV shard, so read the mtimes again
+            self._entries[key] = (self._get_signature(embeddings_dir, db_id), ranker)
+            self._entries.move_to_end(key)
+            self._evict()
+            return ranker
+
+    def _evict(self):
+        while len(self._entries) > 1 and self.current_bytes > self.max_bytes:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def format_stats(self) -> str:
+        stats = self.stats()
+        return (f"Column embeddings cache: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['evictions']} evictions, {stats['entries']} databases resident "
+                f"({stats['bytes'] / 2 ** 20:.1f}/{stats['max_bytes'] / 2 ** 20:.0f} MB)")
+
+
+COLUMN_RANKER_CACHE = ColumnRankerCache(
+    max_bytes=int(float(os.getenv("DFIN_EMBEDDINGS_CACHE_MB", DEFAULT_MAX_MB)) * 2 ** 20),
+    precision=os.getenv("DFIN_EMBEDDINGS_PRECISION", FLOAT32),
+)
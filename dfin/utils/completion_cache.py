@@ -0,0 +1,65 @@
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from .disk_cache import SQLiteCache, hash_key
+
+
+# Bump when a change outside the prompt text (e.g. output parsing) must invalidate cached completions
+COMPLETION_CACHE_VERSION = os.getenv("DFIN_COMPLETION_CACHE_VERSION", "1")
+
+
+class CompletionCache:
+    """
+    Disk backed cache of chat completions.
+
+    Keys hash the full message list, the deployment, the sampling parameters and a prompt template version.
+    Only meant for deterministic (temperature 0) calls, which is all this project makes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, enabled: bool = True):
+        self.store = SQLiteCache(path, max_bytes)
+        self.enabled = enabled
+
+    @staticmethod
+    def key(messages: Any, deployment_id: Optional[str], params: Dict[str, Any], prompt_version: str = "") -> str:
+        payload = json.dumps({"messages": messages, "deployment_id": deployment_id, "params": params}, sort_keys=True)
+        return hash_key(COMPLETION_CACHE_VERSION, prompt_version, payload)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.store.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key: str, completion: str):
+        self.store.set(key, completion.encode('utf-8'))
+
+    def get_or_compute(self, messages: List[Dict[str, str]], deployment_id: Optional[str], params: Dict[str, Any],
+                       compute: Callable[[], str], prompt_version: str = "") -> str:
+        if not self.enabled:
+            return compute()
+        key = self.key(messages, deployment_id, params, prompt_version)
+        completion = self.get(key)
+        if completion is None:
+            completion = compute()
+            self.set(key, completion)
+        return completion
+
+
+COMPLETION_CACHE = CompletionCache(
+    path=os.getenv("DFIN_COMPLETION_CACHE_PATH", "output/cache/completions.sqlite"),
+    max_bytes=int(float(os.getenv("DFIN_COMPLETION_CACHE_MB", 4096)) * 2 ** 20),
+    enabled=os.getenv("DFIN_COMPLETION_CACHE", "1") != "0",
+)
+
+
+def prompt_templates_version(*templates: str) -> str:
+    """Version tag of a set of prompt templates, changes whenever one of them is edited."""
+    return hash_key(*templates)[:16]
+
+
+def enable_langchain_completion_cache(prompt_version: str = ""):
+    """Routes every LangChain LLM call of the process through the completion cache."""
+    import langchain
+    from .langchain_llm import LangChainCompletionCache
+
+    langchain.llm_cache = LangChainCompletionCache(prompt_version) if COMPLETION_CACHE.enabled else None
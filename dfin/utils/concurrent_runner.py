@@ -0,0 +1,45 @@
+import contextvars
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+DEFAULT_CONCURRENCY = int(os.getenv("DFIN_CONCURRENCY", 8))
+# Items submitted ahead of the oldest unfinished one, per worker, so a slow item does not idle the pool
+SUBMIT_AHEAD_PER_WORKER = 4
+
+
+def map_ordered(func: Callable[[T], R], items: Iterable[T], concurrency: int = DEFAULT_CONCURRENCY,
+                thread_name_prefix: str = "worker") -> Iterator[R]:
+    """
+    Like map(func, items), running up to concurrency calls at once in a thread pool.
+
+    Results are yielded in the order of items whatever order they finish in, so anything written from them stays
+    deterministic. Each call runs in a copy of the caller's context (contextvars, e.g. llm_stage tags). The first
+    exception cancels the items not started yet and is raised when its result is reached.
+    """
+    if concurrency <= 1:
+        yield from map(func, items)
+        return
+
+    items = iter(items)
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=thread_name_prefix) as executor:
+        def submit(item: T):
+            pending.append(executor.submit(contextvars.copy_context().run, func, item))
+
+        for item in islice(items, concurrency * SUBMIT_AHEAD_PER_WORKER):
+            submit(item)
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for item in islice(items, 1):
+                    submit(item)
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,256 @@
+import csv
+import json
+import os
+import sys
+import tempfile
+import uuid
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .ivf_index import get_ivf_index_path
+
+
+# On-disk layout of a database shard inside an embeddings directory:
+#   {db_id}.columns.json {"generation": g, "columns": [[table_name, original_column_name], ...] in row order,
+#                        "scales": bool}, renamed in last when the shard is written, it names the files below
+#   {db_id}.{g}.npy      float32 matrix, one row per column description
+#   {db_id}.{g}.scales.npy float32 per row scales, only when the matrix is stored as int8
+#   {db_id}.manifest.json [[table_name, original_column_name, description_hash], ...] of the embedded texts
+# Shards written before generations have a plain list index, {db_id}.npy and {db_id}.scales.npy.
+MATRIX_SUFFIX = ".npy"
+INDEX_SUFFIX = ".columns.json"
+MANIFEST_SUFFIX = ".manifest.json"
+SCALES_SUFFIX = ".scales.npy"
+LEGACY_CSV_SUFFIX = ".csv"
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+PRECISIONS = [FLOAT32, FLOAT16, INT8]
+
+
+class ColumnEmbeddingsStore(NamedTuple):
+    matrix: np.ndarray
+    table_names: List[str]
+    column_names: List[str]
+    scales: Optional[np.ndarray] = None
+
+    def dequantized_matrix(self) -> np.ndarray:
+        return dequantize_matrix(self.matrix, self.scales)
+
+    def rows_for_table(self, table_name: str) -> List[int]:
+        return [i for i, name in enumerate(self.table_names) if name == table_name]
+
+
+# Attempts at loading a shard whose files are removed by a concurrent rewrite in between
+LOAD_ATTEMPTS = 3
+
+
+class ShardIndex(NamedTuple):
+    generation: Optional[str]
+    columns: List[List[str]]
+    has_scales: bool
+
+
+def get_index_path(embeddings_dir: str, db_id: str) -> str:
+    return os.path.join(embeddings_dir, f"{db_id}{INDEX_SUFFIX}")
+
+
+def _shard_paths(embeddings_dir: str, db_id: str, generation: Optional[str]) -> Tuple[str, str]:
+    prefix = os.path.join(embeddings_dir, db_id if generation is None else f"{db_id}.{generation}")
+    return f"{prefix}{MATRIX_SUFFIX}", f"{prefix}{SCALES_SUFFIX}"
+
+
+def read_shard_index(index_path: str) -> ShardIndex:
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    if isinstance(index, list):
+        # Written before generations, the scales are there when the matrix is int8
+        return ShardIndex(None, index, True)
+    return ShardIndex(index["generation"], index["columns"], index["scales"])
+
+
+def get_store_paths(embeddings_dir: str, db_id: str):
+    """The matrix of the current shard of a database and its index, the legacy matrix path when there is none."""
+    index_path = get_index_path(embeddings_dir, db_id)
+    try:
+        generation = read_shard_index(index_path).generation
+    except (OSError, ValueError, KeyError):
+        generation = None
+    return _shard_paths(embeddings_dir, db_id, generation)[0], index_path
+
+
+def quantize_matrix(matrix: np.ndarray, precision: str = FLOAT32) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Converts a float matrix to the given precision.
+
+    int8 uses one scale per row (max absolute value / 127), returned as the second item; it is None otherwise.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if precision == FLOAT32:
+        return matrix, None
+    if precision == FLOAT16:
+        return matrix.astype(np.float16), None
+    if precision == INT8:
+        scales = np.abs(matrix).max(axis=1) / 127 if matrix.size else np.zeros(len(matrix), np.float32)
+        scales[scales == 0] = 1
+        quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+    raise Exception(f"Embeddings precision is missing use the following: {PRECISIONS}")
+
+
+def dequantize_matrix(matrix: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix * scales[:, None] if scales is not None else matrix
+
+
+def _atomic_save(path: str, mode: str, write):
+    # A temporary file of its own, concurrent writers of the same shard do not clobber each other
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _atomic_save_matrix(path: str, matrix: np.ndarray):
+    _atomic_save(path, 'wb', lambda f: np.save(f, matrix))
+
+
+def _atomic_save_json(path: str, data):
+    _atomic_save(path, 'w', lambda f: json.dump(data, f))
+
+
+def write_embeddings_store(embeddings_dir: str, db_id: str, rows: List[Dict], precision: str = FLOAT32):
+    """
+    Persists the column embeddings of a database as a matrix plus a table/column index.
+
+    Args:
+    - embeddings_dir (str): Directory holding one shard per database.
+    - db_id (str): Database name, used as the shard file name.
+    - rows (List[Dict]): Items with 'table_name', 'original_column_name' and 'embedding' keys.
+    - precision (str): float32 (default), float16 or int8 with per row scales.
+    """
+    os.makedirs(embeddings_dir, exist_ok=True)
+    index_path = get_index_path(embeddings_dir, db_id)
+    try:
+        previous = read_shard_index(index_path)
+        previous_paths = _shard_paths(embeddings_dir, db_id, previous.generation)
+    except (OSError, ValueError, KeyError):
+        previous_paths = _shard_paths(embeddings_dir, db_id, None)
+
+    rows = [row for row in rows if row["embedding"] is not None]
+    if rows:
+        matrix = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    index = [[row["table_name"], row["original_column_name"]] for row in rows]
+    matrix, scales = quantize_matrix(matrix, precision)
+
+    # The matrix and scales go to files of a new generation, the index naming them is renamed in last: a reader
+    # gets either the previous shard or the new one as a whole
+    generation = uuid.uuid4().hex[:12]
+    matrix_path, scales_path = _shard_paths(embeddings_dir, db_id, generation)
+    _atomic_save_matrix(matrix_path, matrix)
+    if scales is not None:
+        _atomic_save_matrix(scales_path, scales)
+    # An ANN index lists the rows of the previous shard, it has to be rebuilt
+    ivf_index_path = get_ivf_index_path(embeddings_dir, db_id)
+    if os.path.exists(ivf_index_path):
+        os.remove(ivf_index_path)
+    _atomic_save_json(index_path, {"generation": generation, "columns": index, "scales": scales is not None})
+    # Only the generation replaced here is removed, files of a generation written at the same time by another
+    # process and never committed stay behind
+    for path in previous_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_manifest(embeddings_dir: str, db_id: str) -> Dict[Tuple[str, str], str]:
+    """Returns the description hash of every embedded (table_name, original_column_name), empty if unknown."""
+    manifest_path = os.path.join(embeddings_dir, f"{db_id}{MANIFEST_SUFFIX}")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return {(table_name, column_name): description_hash for table_name, column_name, description_hash in json.load(f)}
+
+
+def write_manifest(embeddings_dir: str, db_id: str, manifest: Dict[Tuple[str, str], str]):
+    manifest_path = os.path.join(embeddings_dir, f"{db_id}{MANIFEST_SUFFIX}")
+    _atomic_save_json(manifest_path, [[table_name, column_name, description_hash]
+                                      for (table_name, column_name), description_hash in manifest.items()])
+
+
+def read_legacy_csv_rows(csv_path: str) -> List[Dict]:
+    """Reads a `table_name,original_column_name,embedding` CSV written by earlier preprocessing runs."""
+    # Some shards hold a single cell larger than the default csv field limit
+    csv.field_size_limit(sys.maxsize)
+    rows = []
+    with open(csv_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            embedding = row["embedding"]
+            rows.append({
+                "table_name": row["table_name"],
+                "original_column_name": row["original_column_name"],
+                # The stringified float lists are valid JSON, which parses much faster than ast.literal_eval
+                "embedding": json.loads(embedding) if embedding else None,
+            })
+    return rows
+
+
+def convert_csv_to_embeddings_store(csv_path: str, embeddings_dir: Optional[str] = None) -> str:
+    """Converts one legacy CSV shard to the binary store next to it (or into embeddings_dir)."""
+    embeddings_dir = embeddings_dir or os.path.dirname(csv_path)
+    db_id = os.path.basename(csv_path)[:-len(LEGACY_CSV_SUFFIX)]
+    write_embeddings_store(embeddings_dir, db_id, read_legacy_csv_rows(csv_path))
+    return get_store_paths(embeddings_dir, db_id)[0]
+
+
+def _is_store_stale(embeddings_dir: str, db_id: str) -> bool:
+    """Whether a legacy CSV shard has no binary store converted from it yet, or only an older one."""
+    csv_path = os.path.join(embeddings_dir, f"{db_id}{LEGACY_CSV_SUFFIX}")
+    if not os.path.exists(csv_path):
+        return False
+    matrix_path, index_path = get_store_paths(embeddings_dir, db_id)
+    if not os.path.exists(matrix_path) or not os.path.exists(index_path):
+        return True
+    return os.path.getmtime(csv_path) > os.path.getmtime(index_path)
+
+
+def load_embeddings_store(embeddings_dir: str, db_id: str) -> ColumnEmbeddingsStore:
+    """
+    Loads the column embeddings of a database, memory-mapping the matrix (no parsing, no copy).
+
+    A legacy CSV shard without an up to date binary store is converted on first use.
+    """
+    if _is_store_stale(embeddings_dir, db_id):
+        convert_csv_to_embeddings_store(os.path.join(embeddings_dir, f"{db_id}{LEGACY_CSV_SUFFIX}"), embeddings_dir)
+
+    index_path = get_index_path(embeddings_dir, db_id)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No column embeddings found for database {db_id} in {embeddings_dir}")
+    for attempt in range(LOAD_ATTEMPTS):
+        index = read_shard_index(index_path)
+        matrix_path, scales_path = _shard_paths(embeddings_dir, db_id, index.generation)
+        try:
+            matrix = np.load(matrix_path, mmap_mode='r')
+            scales = np.load(scales_path) if index.has_scales and matrix.dtype == np.int8 else None
+            break
+        except FileNotFoundError:
+            # Removed by a rewrite of the shard after the index was read, the index now names the new files
+            if attempt == LOAD_ATTEMPTS - 1:
+                raise
+    if len(matrix) != len(index.columns):
+        raise ValueError(f"Embeddings shard of {db_id} has {len(matrix)} vectors for {len(index.columns)} columns")
+    return ColumnEmbeddingsStore(
+        matrix=matrix,
+        table_names=[table_name for table_name, _ in index.columns],
+        column_names=[column_name for _, column_name in index.columns],
+        scales=scales,
+    )
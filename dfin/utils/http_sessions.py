@@ -0,0 +1,237 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .adaptive_concurrency import percentile
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+# Keep-alive connections kept open per endpoint, shared by all threads (sync) or all tasks of a loop (async)
+HTTP_POOL_SIZE = int(os.getenv("DFIN_HTTP_POOL_SIZE", 32))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("DFIN_HTTP_CONNECT_TIMEOUT_SECONDS", 10))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("DFIN_HTTP_READ_TIMEOUT_SECONDS", 120))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("DFIN_HTTP_KEEPALIVE_SECONDS", 60))
+
+
+class AzureOpenAIHTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.headers = headers or {}
+
+
+def deployment_url(api_base: str, deployment_id: str, operation: str) -> str:
+    return f"{api_base.rstrip('/')}/openai/deployments/{deployment_id}/{operation}"
+
+
+def auth_headers(api_type: str, api_key: str) -> Dict[str, str]:
+    if api_type == "azuread":
+        return {"Authorization": f"Bearer {api_key}"}
+    return {"api-key": api_key}
+
+
+def get_endpoint(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class RequestTimings:
+    """Thread-safe per-endpoint connection reuse, connect time and time to first byte of recent requests."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict] = {}
+
+    def record(self, endpoint: str, ttfb: float, connect: Optional[float]):
+        with self._lock:
+            entry = self._stats.setdefault(endpoint, {
+                "requests": 0, "new_connections": 0,
+                "connect": deque(maxlen=self.window), "ttfb": deque(maxlen=self.window),
+            })
+            entry["requests"] += 1
+            entry["ttfb"].append(ttfb)
+            if connect is not None:
+                entry["new_connections"] += 1
+                entry["connect"].append(connect)
+
+    def stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        with self._lock:
+            return {
+                endpoint: {
+                    "requests": entry["requests"],
+                    "new_connections": entry["new_connections"],
+                    "connect_p50": percentile(list(entry["connect"]), 0.5),
+                    "ttfb_p50": percentile(list(entry["ttfb"]), 0.5),
+                    "ttfb_p95": percentile(list(entry["ttfb"]), 0.95),
+                }
+                for endpoint, entry in self._stats.items()
+            }
+
+    def format_stats(self) -> str:
+        def seconds(value):
+            return "-" if value is None else f"{value * 1000:.0f}ms"
+        stats = self.stats()
+        if not stats:
+            return "HTTP: no requests"
+        return "HTTP: " + "; ".join(
+            f"{endpoint} {entry['requests']} requests over {entry['new_connections']} connections, "
+            f"connect p50={seconds(entry['connect_p50'])}, "
+            f"ttfb p50/p95={seconds(entry['ttfb_p50'])}/{seconds(entry['ttfb_p95'])}"
+            for endpoint, entry in stats.items()
+        )
+
+
+HTTP_TIMINGS = RequestTimings()
+
+
+# ----------------------- sync (requests) ----------------------- #
+
+# Connect (TCP + TLS) time of the connection opened by the current thread's request, None when one was reused
+_connect_timing = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started_at = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = time.perf_counter() - started_at
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started_at = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = time.perf_counter() - started_at
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+class SessionPool:
+    """
+    One keep-alive requests.Session per endpoint, shared by every thread.
+
+    Each session keeps up to pool_size idle connections to its endpoint, so concurrent workers reuse them
+    instead of paying a TCP and TLS handshake per call.
+    """
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, connect_timeout: float = HTTP_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = HTTP_READ_TIMEOUT_SECONDS, timings: RequestTimings = HTTP_TIMINGS):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.timings = timings
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(endpoint)
+            if session is None:
+                session = self._sessions[endpoint] = requests.Session()
+                adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+            return session
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        endpoint = get_endpoint(url)
+        _connect_timing.seconds = None
+        response = self.get(endpoint).post(url, timeout=self.timeout, **kwargs)
+        # elapsed runs from sending the request until the response headers are parsed
+        self.timings.record(endpoint, response.elapsed.total_seconds(), _connect_timing.seconds)
+        return response
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+SESSION_POOL = SessionPool()
+
+
+# ----------------------- async (aiohttp) ----------------------- #
+# aiohttp is imported on first use, the sync clients never need it
+
+def _make_trace_config(timings: RequestTimings) -> "aiohttp.TraceConfig":
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started_at = time.perf_counter()
+        context.connect = None
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_started_at = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        context.connect = time.perf_counter() - context.connect_started_at
+
+    async def on_request_end(session, context, params):
+        timings.record(get_endpoint(str(params.url)), time.perf_counter() - context.started_at, context.connect)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+class AsyncSessionPool:
+    """Asyncio counterpart of SessionPool: one aiohttp session per (event loop, endpoint)."""
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, connect_timeout: float = HTTP_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = HTTP_READ_TIMEOUT_SECONDS, keepalive: float = HTTP_KEEPALIVE_SECONDS,
+                 timings: RequestTimings = HTTP_TIMINGS):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self.timings = timings
+        self._sessions: Dict[Tuple[asyncio.AbstractEventLoop, str], "aiohttp.ClientSession"] = {}
+
+    def get(self, endpoint: str) -> "aiohttp.ClientSession":
+        import aiohttp
+
+        key = (asyncio.get_running_loop(), endpoint)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            session = self._sessions[key] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size, keepalive_timeout=self.keepalive),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                trace_configs=[_make_trace_config(self.timings)],
+            )
+        return session
+
+    async def close(self):
+        """Closes the sessions of the running event loop."""
+        loop = asyncio.get_running_loop()
+        for key in [key for key in self._sessions if key[0] is loop]:
+            await self._sessions.pop(key).close()
+
+
+ASYNC_SESSION_POOL = AsyncSessionPool()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+IVF_INDEX_SUFFIX = ".ivf.npz"
+
+
+def get_ivf_index_path(embeddings_dir: str, db_id: str) -> str:
+    return os.path.join(embeddings_dir, f"{db_id}{IVF_INDEX_SUFFIX}")
+
+
+class IVFIndex:
+    """
+    Inverted-file index over normalized column vectors (spherical k-means, pure NumPy).
+
+    A query is only scored against the columns of the n_probe lists whose centroids are closest to it.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: Optional[int] = None, n_iter: int = 20, seed: int = 0) -> "IVFIndex":
+        """
+        Clusters the (already normalized) vectors with spherical k-means.
+
+        Args:
+        - vectors (np.ndarray): Normalized column vectors, one row per column.
+        - n_lists (int): Number of inverted lists, defaults to ~2 * sqrt(number of columns).
+        - n_iter (int): Number of k-means iterations.
+        - seed (int): Seed of the centroid initialization, so rebuilding is deterministic.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_vectors = len(vectors)
+        if n_vectors == 0:
+            return cls(np.zeros((0, vectors.shape[1] if vectors.ndim == 2 else 0), np.float32), np.zeros(0, np.int32))
+
+        n_lists = min(n_lists or max(1, int(2 * np.sqrt(n_vectors))), n_vectors)
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n_vectors, size=n_lists, replace=False)].copy()
+
+        assignments = np.zeros(n_vectors, dtype=np.int32)
+        for _ in range(n_iter):
+            assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+            counts = np.bincount(assignments, minlength=n_lists)
+            order = np.argsort(assignments, kind='stable')
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.zeros_like(centroids)
+            non_empty = np.flatnonzero(counts)
+            sums[non_empty] = np.add.reduceat(vectors[order], starts[non_empty], axis=0)
+
+            # Re-seed empty lists with random columns
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = vectors[rng.choice(n_vectors, size=len(empty), replace=False)]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = sums / norms
+
+        assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+        return cls(centroids, assignments)
+
+    def save(self, path: str):
+        # A temporary file of its own, concurrent builds of the same index do not clobber each other
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, centroids=self.centroids, assignments=self.assignments)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["assignments"])
+
+    def probe(self, question: np.ndarray, n_probe: int) -> np.ndarray:
+        """Boolean mask over the lists, True for the n_probe lists closest to the (normalized) question."""
+        mask = np.zeros(self.n_lists, dtype=bool)
+        if self.n_lists:
+            centroid_scores = self.centroids @ question
+            n_probe = min(max(n_probe, 1), self.n_lists)
+            mask[np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]] = True
+        return mask
+
+
+def ann_recall(
+    exact_results: Sequence[Dict[str, List[str]]],
+    ann_results: Sequence[Dict[str, List[str]]]
+) -> float:
+    """Mean recall of the ANN top-k lists against the exact ones, over all (question, table) pairs."""
+    recalls = []
+    for exact, ann in zip(exact_results, ann_results):
+        for table_name, exact_columns in exact.items():
+            if exact_columns:
+                recalls.append(len(set(exact_columns) & set(ann.get(table_name, []))) / len(exact_columns))
+    return float(np.mean(recalls)) if recalls else 1.0
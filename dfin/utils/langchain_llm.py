@@ -0,0 +1,233 @@
+import json
+import time
+from typing import Any, Iterator, List, Optional
+
+from langchain.chat_models import AzureChatOpenAI
+from langchain.schema import BaseCache, ChatGeneration, Generation
+from langchain.schema.messages import AIMessage, AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+from .aad_token import AADTokenProvider, TOKEN_PROVIDER
+from .adaptive_concurrency import AdaptiveConcurrencyLimiter
+from .azure_openai import AZ_OAI_API_VERSION, AZ_OAI_COMPLETION_TOKENS_ESTIMATE, AZURE_OPENAI_CLIENT, \
+    AzureOpenAIClient, configure_openai_module, get_token, record_chat_usage, retry
+from .completion_cache import COMPLETION_CACHE, COMPLETION_CACHE_VERSION, CompletionCache
+from .disk_cache import hash_key
+from .rate_limiter import RateLimiter, estimate_chat_tokens
+from .streaming_sql import IncrementalSQLParser, STREAMING_STATS, STREAM_SQL, STREAM_SQL_EARLY_STOP
+from .usage_metrics import current_stage
+
+
+class LangChainChatCompletion:
+    """Stands in for openai.ChatCompletion in the LangChain LLMs, sending their requests through AZURE_OPENAI_CLIENT."""
+
+    # openai.ChatCompletion.create arguments that are not part of the request body
+    CLIENT_PARAMS = {"api_key", "api_base", "api_type", "api_version", "organization", "engine", "deployment_id",
+                     "request_timeout"}
+
+    def __init__(self, client: AzureOpenAIClient = AZURE_OPENAI_CLIENT):
+        self.client = client
+
+    def create(self, **kwargs):
+        """The response, or with stream=True an iterator over its chunks once the request has been accepted."""
+        payload = {key: value for key, value in kwargs.items()
+                   if key not in self.CLIENT_PARAMS and key != "stream" and value is not None}
+        deployment_id = kwargs.get("engine") or kwargs.get("deployment_id")
+        if kwargs.get("stream"):
+            response = self.client.open_chat_stream(kwargs["api_base"], kwargs["api_key"], deployment_id, payload)
+            return self.client.iter_chat_stream(response)
+        return self.client.post(kwargs["api_base"], kwargs["api_key"], deployment_id, "chat/completions", payload)
+
+
+class RateLimitedAzureChatOpenAI(AzureChatOpenAI):
+    """
+    AzureChatOpenAI admitting each API call (cache hits are not counted) through a RateLimiter and an
+    AdaptiveConcurrencyLimiter, retried with the azure_openai retry policy instead of LangChain's.
+    With a token_provider, every call uses its current token, so a long-lived instance keeps working
+    across token refreshes.
+    """
+
+    rate_limiter: Optional[RateLimiter] = None
+    concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+    token_provider: Optional[AADTokenProvider] = None
+    # Model name used for the usage metrics and their cost
+    usage_model: str = "gpt-4"
+    # With streaming, the marker of the SQL statement to follow in the completion, see with_sql_streaming
+    sql_marker: Optional[str] = None
+    sql_early_stop: bool = STREAM_SQL_EARLY_STOP
+
+    @property
+    def _client_params(self):
+        params = super()._client_params
+        if self.token_provider is not None:
+            params["api_key"] = self.token_provider.get_token().token
+        return params
+
+    def _get_llm_string(self, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        # Cache key of the completions: dumps(self) would include the repr of the limiters and token provider,
+        # memory addresses included, so nothing cached by another process would ever be found
+        params = {
+            "deployment_name": self.deployment_name,
+            "openai_api_version": self.openai_api_version,
+            **self._default_params,
+            "sql_marker": self.sql_marker,
+            "sql_early_stop": self.sql_early_stop,
+            "stop": stop,
+            **kwargs,
+        }
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def _completion_attempt(self, **kwargs):
+        messages = kwargs.get("messages", [])
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(estimate_chat_tokens(messages, AZ_OAI_COMPLETION_TOKENS_ESTIMATE))
+        started_at = time.monotonic()
+        if self.concurrency_limiter is None:
+            response = self.client.create(**kwargs)
+        else:
+            with self.concurrency_limiter.slot():
+                response = self.client.create(**kwargs)
+        record_chat_usage(self.usage_model, messages, response["choices"][0]["message"]["content"] or "", started_at)
+        return response
+
+    def completion_with_retry(self, run_manager=None, **kwargs):
+        return retry(max_retries=self.max_retries, deployment=self.deployment_name)(self._completion_attempt)(**kwargs)
+
+    def _open_stream_attempt(self, **kwargs):
+        # The concurrency slot stays taken until the stream is read, _stream releases it
+        messages = kwargs.get("messages", [])
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(estimate_chat_tokens(messages, AZ_OAI_COMPLETION_TOKENS_ESTIMATE))
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.acquire()
+        started_at = time.monotonic()
+        try:
+            return self.client.create(**kwargs)
+        except BaseException as e:
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.release(time.monotonic() - started_at, e)
+            raise
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        """
+        Streams the completion through the pooled client. Only opening the stream is retried, a stream failing
+        half way raises. With sql_marker, an IncrementalSQLParser follows the statement after it (or from the
+        start of the completion when the prompt ends with the marker): time to the
+        first SQL character goes to STREAMING_STATS and, with sql_early_stop, reading stops at its end.
+        """
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params = {**params, **kwargs, "stream": True}
+        parser = None
+        if self.sql_marker:
+            # The easy class prompt ends with the marker, its completion is the statement itself
+            prompt_end = message_dicts[-1]["content"].rstrip() if message_dicts else ""
+            parser = IncrementalSQLParser(self.sql_marker, after_marker=prompt_end.endswith(self.sql_marker))
+        started_at = time.monotonic()
+        chunks = retry(max_retries=self.max_retries, deployment=self.deployment_name)(self._open_stream_attempt)(
+            messages=message_dicts, **params)
+        opened_at = time.monotonic()
+        first_token = first_sql = None
+        completion = []
+        error = None
+        try:
+            for chunk in chunks:
+                if not chunk["choices"]:
+                    continue
+                choice = chunk["choices"][0]
+                content = choice["delta"].get("content") or ""
+                if content and first_token is None:
+                    first_token = time.monotonic() - started_at
+                if parser is not None and content:
+                    found = parser.found
+                    complete = parser.feed(content)
+                    if not found and parser.found:
+                        first_sql = time.monotonic() - started_at
+                    if complete and self.sql_early_stop:
+                        content = parser.cut(content)
+                completion.append(content)
+                finish_reason = choice.get("finish_reason")
+                yield ChatGenerationChunk(
+                    message=AIMessageChunk(content=content),
+                    generation_info=dict(finish_reason=finish_reason) if finish_reason is not None else None,
+                )
+                if run_manager:
+                    run_manager.on_llm_new_token(content)
+                if parser is not None and parser.complete and self.sql_early_stop:
+                    break
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            chunks.close()
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.release(time.monotonic() - opened_at, error)
+            if error is None:
+                record_chat_usage(self.usage_model, message_dicts, "".join(completion), started_at)
+                STREAMING_STATS.record(current_stage(), first_token, first_sql, time.monotonic() - started_at,
+                                       parser is not None and parser.complete and self.sql_early_stop)
+
+
+def get_langchain_llm(api_base: str, deployment_id: str, rate_limiter: RateLimiter,
+                       concurrency_limiter: AdaptiveConcurrencyLimiter, usage_model: str) -> RateLimitedAzureChatOpenAI:
+    """A long-lived LLM, build it once: the token is renewed in the background and read on every call."""
+    configure_openai_module()
+    TOKEN_PROVIDER.start_background_refresh()
+    llm = RateLimitedAzureChatOpenAI(
+        openai_api_base=api_base,
+        openai_api_version=AZ_OAI_API_VERSION,
+        deployment_name=deployment_id,
+        openai_api_type="azuread",
+        openai_api_key=get_token().token,
+        rate_limiter=rate_limiter,
+        concurrency_limiter=concurrency_limiter,
+        token_provider=TOKEN_PROVIDER,
+        usage_model=usage_model,
+    )
+    # Set after validation, which always installs openai.ChatCompletion
+    llm.client = LangChainChatCompletion()
+    return llm
+
+
+def with_sql_streaming(llm: RateLimitedAzureChatOpenAI, sql_marker: str, early_stop: bool = STREAM_SQL_EARLY_STOP,
+                       enabled: bool = STREAM_SQL) -> RateLimitedAzureChatOpenAI:
+    """
+    A copy of llm streaming its completions and following the SQL statement after sql_marker, sharing its
+    client and limiters. llm itself when streaming is not enabled (DFIN_STREAM_SQL=1).
+    """
+    if not enabled:
+        return llm
+    # copy() would drop the fields LangChain excludes from serialization, such as callbacks
+    return type(llm).construct(**{**llm.__dict__, "streaming": True, "sql_marker": sql_marker,
+                                  "sql_early_stop": early_stop})
+
+
+class LangChainCompletionCache(BaseCache):
+    """
+    LangChain llm_cache backed by COMPLETION_CACHE.
+
+    LangChain already passes the serialized message list as prompt and the model settings (deployment,
+    temperature, ...) as llm_string; both go into the key together with the prompt template version.
+    """
+
+    def __init__(self, prompt_version: str = "", cache: CompletionCache = COMPLETION_CACHE):
+        self.prompt_version = prompt_version
+        self.cache = cache
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        return hash_key(COMPLETION_CACHE_VERSION, self.prompt_version, llm_string, prompt)
+
+    def lookup(self, prompt: str, llm_string: str):
+        value = self.cache.store.get(self._key(prompt, llm_string))
+        if value is None:
+            return None
+        return [
+            ChatGeneration(message=AIMessage(content=item["text"])) if item["chat"] else Generation(text=item["text"])
+            for item in json.loads(value)
+        ]
+
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        value = [{"text": generation.text, "chat": isinstance(generation, ChatGeneration)} for generation in return_val]
+        self.cache.store.set(self._key(prompt, llm_string), json.dumps(value).encode('utf-8'))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.cache.store.clear()
@@ -0,0 +1,180 @@
+import codecs
+import json
+import mmap
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from .prediction_journal import write_json_atomically
+
+
+# Sidecar next to a links file: {"size", "mtime_ns", "offsets": {question_id: [start, length]}} in bytes, rebuilt
+# whenever the links file changes
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 2
+
+# JSON whitespace only, the byte offsets count every character skipped
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Bytes of the links file decoded at a time while building the index
+SCAN_CHUNK_BYTES = 2 ** 20
+
+
+def column_links_file(linked_columns_dir: str, mode: str, top_k: int) -> str:
+    """The column links written by `dfin_sql_focus_step.py --steps columns --mode mode --top-k top_k`."""
+    return f"{linked_columns_dir}/column_links_results_{mode}_top_k_{top_k}.json"
+
+
+def scan_entry_offsets(data) -> List[Tuple[int, int, int]]:
+    """
+    (question_id, byte start, byte length) of every entry of a JSON array of links, in file order.
+
+    data is the file as bytes or a memory map; it is decoded SCAN_CHUNK_BYTES at a time and every entry is parsed
+    once, so the whole file is never held as text.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    # text[i] is at byte offset position of data, the text before i is no longer needed
+    text, i, position, read = "", 0, 0, 0
+    offsets = []
+
+    def refill() -> bool:
+        nonlocal text, i, read
+        if read >= len(data):
+            return False
+        chunk = data[read:read + SCAN_CHUNK_BYTES]
+        read += len(chunk)
+        text, i = text[i:] + utf8.decode(chunk, final=read >= len(data)), 0
+        return True
+
+    def skip_whitespace():
+        nonlocal i, position
+        while True:
+            end = _WHITESPACE.match(text, i).end()
+            position += end - i
+            i = end
+            if i < len(text) or not refill():
+                return
+
+    skip_whitespace()
+    if text[i:i + 1] != "[":
+        raise ValueError("Links file is not a JSON array")
+    i, position = i + 1, position + 1
+    skip_whitespace()
+    if text[i:i + 1] == "]":
+        return offsets
+    while True:
+        while True:
+            try:
+                entry, end = decoder.raw_decode(text, i)
+                break
+            except json.JSONDecodeError:
+                # The entry goes on in the next chunk
+                if not refill():
+                    raise
+        length = len(text[i:end].encode("utf-8"))
+        offsets.append((int(entry["question_id"]), position, length))
+        i, position = end, position + length
+        skip_whitespace()
+        separator = text[i:i + 1]
+        if separator == "]":
+            return offsets
+        if separator != ",":
+            raise ValueError(f"Malformed links file at byte {position}")
+        i, position = i + 1, position + 1
+        skip_whitespace()
+
+
+class ColumnLinksStore:
+    """
+    Column links of a preprocessed links file, looked up by question_id.
+
+    The file is memory-mapped and only the entry asked for is parsed. Entry offsets come from a sidecar index, built
+    with a single chunked pass over the map the first time (or after the file changed) and reused by later runs, so
+    opening the store does not parse the links. Thread-safe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._offsets: Optional[Dict[int, Tuple[int, int]]] = None
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self.index_built = False
+
+    def _file_signature(self) -> Dict:
+        stat = os.stat(self.path)
+        return {"version": INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _load_index(self, signature: Dict) -> Optional[Dict[int, Tuple[int, int]]]:
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if any(index.get(key) != value for key, value in signature.items()):
+            return None
+        return {int(question_id): (start, length) for question_id, (start, length) in index["offsets"].items()}
+
+    def _build_index(self, signature: Dict) -> Dict[int, Tuple[int, int]]:
+        entries = scan_entry_offsets(self._map if self._map is not None else b"")
+        # Like the linear scan it replaces, the first entry of a question_id wins
+        offsets = {}
+        for question_id, start, length in entries:
+            offsets.setdefault(question_id, (start, length))
+        try:
+            write_json_atomically(self.index_path, {**signature, "offsets": offsets}, indent=None)
+        except OSError as e:
+            print(f"Column links index not saved to {self.index_path}: {e}")
+        self.index_built = True
+        return offsets
+
+    def _open(self):
+        with self._lock:
+            if self._offsets is not None:
+                return
+            signature = self._file_signature()
+            self._file = open(self.path, "rb")
+            if signature["size"]:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets = self._load_index(signature)
+            if offsets is None:
+                offsets = self._build_index(signature)
+            self._offsets = offsets
+
+    def column_links(self, question_id: int) -> Optional[Dict[str, List[str]]]:
+        self._open()
+        offset = self._offsets.get(int(question_id))
+        if offset is None:
+            return None
+        start, length = offset
+        return json.loads(self._map[start:start + length])["column_links"]
+
+    def question_ids(self) -> List[int]:
+        self._open()
+        return list(self._offsets)
+
+    def __contains__(self, question_id) -> bool:
+        self._open()
+        return int(question_id) in self._offsets
+
+    def __len__(self) -> int:
+        self._open()
+        return len(self._offsets)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._offsets = None
+
+
+@lru_cache(maxsize=None)
+def open_column_links_store(path: str) -> ColumnLinksStore:
+    return ColumnLinksStore(path)
@@ -1,22 +1,29 @@
 import json
 from typing import List
-from sqlglot import exp, parse_one
-from sqlglot.dialects import Dialects
 
 
 def get_query_tables(query: str) -> List[str]:
     # Returns all the table names which are used in the query
+    from sqlglot import exp, parse_one
+    from sqlglot.dialects import Dialects
+
     parsed = parse_one(query, read=Dialects.SQLITE)
     return sorted(list({str(table.this).strip() for table in parsed.find_all(exp.Table)}))
 
 
 def get_query_columns(query: str) -> List[str]:
     # Returns all the table names which are used in the query
+    from sqlglot import exp, parse_one
+    from sqlglot.dialects import Dialects
+
     parsed = parse_one(query, read=Dialects.SQLITE)
     return sorted(list({str(table.this).strip() for table in parsed.find_all(exp.Column)}))
 
 
 def get_columns_usage(query):
+    from sqlglot import exp, parse_one
+    from sqlglot.dialects import Dialects
+
     parsed = parse_one(query, read=Dialects.SQLITE)
     table_aliases = {}
     for table in parsed.find_all(exp.Table):
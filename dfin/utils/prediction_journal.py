@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional, Set
+
+from .run_log import RunLog, read_run_log, RUN_LOG_FSYNC
+
+
+BIRD_SEPARATOR = "\t----- bird -----\t"
+
+
+def bird_prediction(sql: str, db_id: str) -> str:
+    """A prediction the way the BIRD evaluation scripts read it."""
+    return f"{sql}{BIRD_SEPARATOR}{db_id}"
+
+
+def write_json_atomically(path: str, data, indent: Optional[int] = 4):
+    """Writes to a temporary file next to path and renames it over path, readers see the old or the new file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Persist the rename itself
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class PredictionJournal:
+    """
+    Predictions appended to a JSON lines journal, materialized as the BIRD `{"idx": "sql\\t----- bird -----\\tdb_id"}`
+    JSON on demand.
+
+    Recording a prediction appends one line whatever the number of predictions so far, and the JSON is replaced
+    atomically, so killing the process at any point leaves both files readable. Each entry carries the run
+    configuration (links file, prompt version, ...) it was predicted with: a journal with a config only sees the
+    entries of that configuration, the JSON holds their latest prediction per index and nothing else.
+    """
+
+    def __init__(self, journal_path: str, output_path: str, config: Optional[Dict] = None,
+                 fsync_policy: str = RUN_LOG_FSYNC):
+        self.journal_path = journal_path
+        self.output_path = output_path
+        self.config = config
+        self._log = RunLog(journal_path, fsync_policy)
+
+    def record(self, index: int, sql: str, db_id: str, question_id: Optional[int] = None):
+        self._log.append({"index": int(index), "question_id": question_id, "sql": sql, "db_id": db_id,
+                          "config": self.config})
+
+    def entries(self) -> List[Dict]:
+        """The journal entries of this configuration (all of them without one), from earlier runs too."""
+        entries = read_run_log(self.journal_path)
+        if self.config is None:
+            return entries
+        return [entry for entry in entries if entry.get("config") == self.config]
+
+    def latest_config(self) -> Optional[Dict]:
+        """The configuration of the last recorded prediction."""
+        entries = read_run_log(self.journal_path)
+        return entries[-1].get("config") if entries else None
+
+    def question_ids(self) -> Set[int]:
+        """The questions with a recorded prediction in this configuration."""
+        return {entry["question_id"] for entry in self.entries() if entry.get("question_id") is not None}
+
+    def predictions(self) -> Dict[str, str]:
+        predictions = {str(entry["index"]): bird_prediction(entry["sql"], entry["db_id"]) for entry in self.entries()}
+        return dict(sorted(predictions.items(), key=lambda item: int(item[0])))
+
+    def materialize(self) -> int:
+        """Writes the BIRD JSON from the journal and returns the number of predictions in it."""
+        predictions = self.predictions()
+        write_json_atomically(self.output_path, predictions)
+        return len(predictions)
+
+    def close(self):
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
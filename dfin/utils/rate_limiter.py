@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .tokens import count_tokens
+
+
+# Chat requests are counted against the TPM quota with their expected completion size
+DEFAULT_COMPLETION_TOKENS_ESTIMATE = 512
+# Fixed per message overhead of the chat format (role, separators)
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at rate_per_minute up to a one-minute burst.
+
+    Callers reserve ahead: the level may go negative and the returned wait is when the reservation is covered,
+    so concurrent callers queue up in order instead of all polling the bucket. Not locked itself.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        # A single request above the quota can never fit, it is charged the full bucket instead
+        self.level -= min(amount, self.capacity)
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+
+class RateLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute budget of one deployment.
+
+    Reservations are made under a threading lock and only the wait happens outside of it, so the same limiter
+    is shared by worker threads (acquire) and asyncio tasks (aacquire). A budget of 0 means unlimited.
+    """
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = TokenBucket(rpm) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+        self.waited_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self._requests is not None or self._tokens is not None
+
+    def reserve(self, tokens: int) -> float:
+        """Books one request of the given tokens and returns how long to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            self.requests += 1
+            self.tokens += tokens
+            self.waited_seconds += wait
+            return wait
+
+    def acquire(self, tokens: int):
+        if self.enabled:
+            wait = self.reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+
+    async def aacquire(self, tokens: int):
+        if self.enabled:
+            wait = self.reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def format_stats(self) -> str:
+        return (f"{self.name} {self.requests} requests, {self.tokens} estimated tokens, "
+                f"{self.waited_seconds:.1f}s waited (rpm={self.rpm or 'unlimited'}, tpm={self.tpm or 'unlimited'})")
+
+
+def estimate_chat_tokens(messages: List[Dict[str, str]],
+                         completion_tokens: Optional[int] = DEFAULT_COMPLETION_TOKENS_ESTIMATE) -> int:
+    """Local estimate of the tokens a chat request is charged: the prompt plus the expected completion."""
+    prompt_tokens = sum(count_tokens(message["content"]) + CHAT_MESSAGE_OVERHEAD_TOKENS for message in messages)
+    return prompt_tokens + (completion_tokens or 0)
+
+
+def estimate_embedding_tokens(docs: List[str]) -> int:
+    return sum(count_tokens(doc) for doc in docs)
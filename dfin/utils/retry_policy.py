@@ -0,0 +1,163 @@
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple, Type
+
+
+# HTTP statuses worth another attempt: timeouts, throttling and server side failures
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY_SECONDS = float(os.getenv("DFIN_RETRY_BASE_DELAY_SECONDS", 1))
+DEFAULT_MAX_DELAY_SECONDS = float(os.getenv("DFIN_RETRY_MAX_DELAY_SECONDS", 60))
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("DFIN_RETRY_DEADLINE_SECONDS", 300))
+
+
+@lru_cache(maxsize=None)
+def retryable_exceptions() -> Tuple[Type[BaseException], ...]:
+    """Transport and openai errors worth another attempt, imported on first use to keep this module light."""
+    import openai.error
+    import requests
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        ConnectionError,
+        TimeoutError,
+    )
+
+
+def get_status(error: BaseException) -> Optional[int]:
+    """HTTP status of an openai (http_status) or async client (status) error, None for transport errors."""
+    status = getattr(error, "http_status", None) or getattr(error, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the server asked to wait (retry-after-ms or Retry-After, in seconds or as an HTTP date)."""
+    headers = getattr(error, "headers", None) or {}
+    headers = {str(name).lower(): value for name, value in headers.items()}
+    if "retry-after-ms" in headers:
+        try:
+            return max(float(headers["retry-after-ms"]) / 1000, 0)
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            return max(float(headers["retry-after"]), 0)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(headers["retry-after"])
+        except (TypeError, ValueError):
+            return None
+        return max(retry_at.timestamp() - time.time(), 0)
+    return None
+
+
+def is_retryable(error: BaseException, extra_retryable: Iterable[Type[BaseException]] = ()) -> bool:
+    """
+    Classifies an error as retryable (throttling, timeouts, transient server or network failures) or fatal.
+
+    An HTTP status decides when there is one, so e.g. a 400 for a too long prompt fails right away.
+    """
+    status = get_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, retryable_exceptions() + tuple(extra_retryable))
+
+
+class RetryStats:
+    """Thread-safe per-deployment counters of retries, failures and time spent backing off."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _entry(self, deployment: str) -> Dict[str, float]:
+        return self._stats.setdefault(deployment, {
+            "retries": 0, "throttled": 0, "fatal": 0, "exhausted": 0, "backoff_seconds": 0.0,
+        })
+
+    def record_retry(self, deployment: str, delay: float, throttled: bool):
+        with self._lock:
+            entry = self._entry(deployment)
+            entry["retries"] += 1
+            entry["throttled"] += int(throttled)
+            entry["backoff_seconds"] += delay
+
+    def record_failure(self, deployment: str, retryable: bool):
+        with self._lock:
+            self._entry(deployment)["exhausted" if retryable else "fatal"] += 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {deployment: dict(entry) for deployment, entry in self._stats.items()}
+
+    def format_stats(self) -> str:
+        stats = self.stats()
+        if not stats:
+            return "Retries: none"
+        return "Retries: " + ", ".join(
+            f"{deployment} {entry['retries']} retries ({entry['throttled']} throttled, "
+            f"{entry['backoff_seconds']:.1f}s backing off, {entry['exhausted']} exhausted, {entry['fatal']} fatal)"
+            for deployment, entry in stats.items()
+        )
+
+
+RETRY_STATS = RetryStats()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, capped per sleep by max_delay and overall by a deadline.
+
+    A Retry-After sent by the server replaces the computed delay. Shared by the sync and asyncio retry decorators,
+    which only differ in how they sleep.
+    """
+
+    def __init__(self, max_retries: int = DEFAULT_MAX_RETRIES, base_delay: float = DEFAULT_BASE_DELAY_SECONDS,
+                 max_delay: float = DEFAULT_MAX_DELAY_SECONDS, deadline: float = DEFAULT_DEADLINE_SECONDS,
+                 deployment: Optional[str] = None, extra_retryable: Iterable[Type[BaseException]] = (),
+                 stats: RetryStats = RETRY_STATS):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.deployment = deployment or "default"
+        self.extra_retryable = tuple(extra_retryable)
+        self.stats = stats
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def next_delay(self, error: BaseException, attempt: int, started_at: float) -> Optional[float]:
+        """Seconds to wait before the next attempt, None when the error must be raised."""
+        retryable = is_retryable(error, self.extra_retryable)
+        if not retryable or attempt >= self.max_retries:
+            self.stats.record_failure(self.deployment, retryable)
+            return None
+
+        retry_after = get_retry_after(error)
+        delay = retry_after if retry_after is not None else self.backoff(attempt)
+        if time.monotonic() + delay - started_at > self.deadline:
+            self.stats.record_failure(self.deployment, retryable)
+            return None
+
+        import openai.error
+        throttled = get_status(error) == 429 or isinstance(error, openai.error.RateLimitError)
+        self.stats.record_retry(self.deployment, delay, throttled)
+        logger.warning("retry deployment=%s attempt=%d/%d delay=%.2fs retry_after=%s error=%s: %s", self.deployment,
+                       attempt + 1, self.max_retries, delay, retry_after, type(error).__name__, error)
+        return delay
@@ -0,0 +1,113 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+# When appended records are forced to disk: after every record, at most every RUN_LOG_FSYNC_SECONDS, or on close
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = [FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER]
+
+RUN_LOG_FSYNC = os.getenv("DFIN_RUN_LOG_FSYNC", FSYNC_INTERVAL)
+RUN_LOG_FSYNC_SECONDS = float(os.getenv("DFIN_RUN_LOG_FSYNC_SECONDS", 5))
+
+CSV = "csv"
+PARQUET = "parquet"
+COMPACT_FORMATS = [CSV, PARQUET]
+
+
+def parquet_engine_available() -> bool:
+    return any(importlib.util.find_spec(engine) is not None for engine in ("pyarrow", "fastparquet"))
+
+
+class RunLog:
+    """
+    Append-only JSON lines log of a run, one record per processed question.
+
+    Appending costs the size of the record only, whatever was logged before. Every record is written with a single
+    write and flushed to the OS, so a crash loses at most the record being written; fsync_policy decides how often
+    the file is also forced to disk. Thread-safe, workers can log their records directly.
+    """
+
+    def __init__(self, path: str, fsync_policy: str = RUN_LOG_FSYNC, fsync_seconds: float = RUN_LOG_FSYNC_SECONDS):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy}, use one of {FSYNC_POLICIES}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_seconds = fsync_seconds
+        self._lock = threading.Lock()
+        self._file = None
+        self._synced_at = time.monotonic()
+        self.records = 0
+
+    def append(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self.records += 1
+            now = time.monotonic()
+            if self.fsync_policy == FSYNC_ALWAYS or (
+                    self.fsync_policy == FSYNC_INTERVAL and now - self._synced_at >= self.fsync_seconds):
+                os.fsync(self._file.fileno())
+                self._synced_at = now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self.fsync_policy != FSYNC_NEVER:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_run_log(path: str) -> List[Dict]:
+    """The records of a run log, a last line cut short by a crash is skipped."""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def compact_run_log(path: str, output_path: str, columns: List[str], key: Optional[str] = "index",
+                    output_format: str = CSV) -> int:
+    """
+    Writes the run log as one CSV or Parquet table of the given columns and returns its row count.
+
+    Questions logged by several runs keep their latest record (by key), rows are sorted by key.
+    Parquet needs pyarrow or fastparquet installed.
+    """
+    import pandas as pd
+
+    if output_format not in COMPACT_FORMATS:
+        raise ValueError(f"Unknown compaction format {output_format}, use one of {COMPACT_FORMATS}")
+    records = read_run_log(path)
+    if key is not None:
+        records = sorted({record[key]: record for record in records}.values(), key=lambda record: record[key])
+    df = pd.DataFrame([[record.get(column) for column in columns] for record in records], columns=columns)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if output_format == PARQUET:
+        df.to_parquet(output_path, index=False)
+    else:
+        df.to_csv(output_path, index=False)
+    return len(df)
@@ -0,0 +1,137 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+from .adaptive_concurrency import percentile
+
+
+# Markers read by extract_sql_query and extract_revised_sql_query
+SQL_MARKER = "SQL:"
+REVISED_SQL_MARKER = "Revised_SQL:"
+
+# Stream the SQL generation and self-correction completions, and stop reading once the statement is complete
+STREAM_SQL = os.getenv("DFIN_STREAM_SQL", "0") == "1"
+STREAM_SQL_EARLY_STOP = os.getenv("DFIN_STREAM_SQL_EARLY_STOP", "1") == "1"
+
+QUOTES = "'\"`"
+
+
+class IncrementalSQLParser:
+    """
+    Finds the SQL statement after marker in a completion fed chunk by chunk, the way extract_sql_query would.
+
+    The statement is complete at a `;` outside quotes or at a blank line after it, so a caller can stop reading
+    the stream there instead of waiting for trailing text. Every character is scanned once. With after_marker
+    (the prompt already ends with the marker, e.g. `SQL: `), the statement starts with the completion.
+    """
+
+    def __init__(self, marker: str = SQL_MARKER, after_marker: bool = False):
+        self.marker = marker
+        self.text = ""
+        # Index right after the marker, then of the first statement character, then right after the statement
+        self.marker_end: Optional[int] = 0 if after_marker else None
+        self.sql_start: Optional[int] = None
+        self.sql_end: Optional[int] = None
+        self._scanned = 0
+        self._quote: Optional[str] = None
+        self._newlines = 0
+
+    @property
+    def found(self) -> bool:
+        return self.sql_start is not None
+
+    @property
+    def complete(self) -> bool:
+        return self.sql_end is not None
+
+    @property
+    def sql(self) -> Optional[str]:
+        if self.sql_start is None:
+            return None
+        return self.text[self.sql_start:self.sql_end].strip()
+
+    def feed(self, chunk: str) -> bool:
+        """Adds the next chunk of the completion and returns whether the statement is complete."""
+        if self.complete:
+            return True
+        self.text += chunk
+        if self.marker_end is None:
+            # The marker may straddle two chunks
+            position = self.text.find(self.marker, max(self._scanned - len(self.marker) + 1, 0))
+            if position < 0:
+                self._scanned = len(self.text)
+                return False
+            self.marker_end = self._scanned = position + len(self.marker)
+        self._scan()
+        return self.complete
+
+    def _scan(self):
+        text = self.text
+        for position in range(self._scanned, len(text)):
+            char = text[position]
+            if self.sql_start is None:
+                if char.isspace():
+                    continue
+                self.sql_start = position
+            if self._quote is not None:
+                if char == self._quote:
+                    self._quote = None
+            elif char in QUOTES:
+                self._quote = char
+            elif char == ";":
+                self.sql_end = position + 1
+                break
+            if char == "\n":
+                self._newlines += 1
+                if self._newlines >= 2 and self._quote is None:
+                    self.sql_end = position - 1
+                    break
+            elif not char.isspace():
+                self._newlines = 0
+        self._scanned = len(text)
+
+    def cut(self, chunk: str) -> str:
+        """The part of the last fed chunk up to the end of the statement, the whole chunk before it is complete."""
+        if self.sql_end is None:
+            return chunk
+        return chunk[:max(len(chunk) - (len(self.text) - self.sql_end), 0)]
+
+
+def _format_seconds(values: List[float], q: float) -> str:
+    value = percentile(values, q)
+    return "-" if value is None else f"{value:.2f}s"
+
+
+class StreamingStats:
+    """Thread-safe time to first token and to first SQL character of the streamed completions, per stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, List[float]]] = {}
+        self._early_stops: Dict[str, int] = {}
+
+    def record(self, stage: str, first_token: Optional[float], first_sql: Optional[float], total: float,
+               early_stopped: bool):
+        with self._lock:
+            entry = self._stats.setdefault(stage, {"first_token": [], "first_sql": [], "total": []})
+            if first_token is not None:
+                entry["first_token"].append(first_token)
+            if first_sql is not None:
+                entry["first_sql"].append(first_sql)
+            entry["total"].append(total)
+            self._early_stops[stage] = self._early_stops.get(stage, 0) + int(early_stopped)
+
+    def format_stats(self) -> str:
+        with self._lock:
+            if not self._stats:
+                return "Streaming: none"
+            return "Streaming: " + ", ".join(
+                f"{stage} {len(entry['total'])} calls (first token p50 {_format_seconds(entry['first_token'], 0.5)}, "
+                f"first SQL p50 {_format_seconds(entry['first_sql'], 0.5)} "
+                f"p95 {_format_seconds(entry['first_sql'], 0.95)}, total p95 {_format_seconds(entry['total'], 0.95)}, "
+                f"{self._early_stops[stage]} stopped early)"
+                for stage, entry in self._stats.items()
+            )
+
+
+STREAMING_STATS = StreamingStats()
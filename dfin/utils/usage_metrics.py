@@ -0,0 +1,133 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .adaptive_concurrency import percentile
+
+
+# USD per 1K tokens (prompt, completion) of the models behind the deployments
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "ada-2": (0.0001, 0.0),
+}
+STAGES = ["table_linking", "schema_linking", "classification", "easy", "non_nested", "nested", "self_correction",
+          "table_description", "embedding"]
+EMBEDDING_STAGE = "embedding"
+UNTAGGED_STAGE = "untagged"
+
+# Stage and database of the calls made by the current thread or task, set with llm_stage
+_current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_stage", default=None)
+_current_db_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_db_id", default=None)
+
+
+@contextmanager
+def llm_stage(stage: str, db_id: Optional[str] = None):
+    """Tags the LLM calls made inside the block with a stage (and database, kept from the outer block if None)."""
+    stage_token = _current_stage.set(stage)
+    db_token = _current_db_id.set(db_id) if db_id is not None else None
+    try:
+        yield
+    finally:
+        _current_stage.reset(stage_token)
+        if db_token is not None:
+            _current_db_id.reset(db_token)
+
+
+def current_stage() -> str:
+    return _current_stage.get() or UNTAGGED_STAGE
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class UsageMetrics:
+    """
+    Per call token, latency and cost records, appended as JSON lines to path and aggregated in memory.
+
+    Token counts come from the local tokenizer (utils.tokens), so they are available for every client path.
+    Records carry the run_id of the process, so one file can hold many runs.
+    """
+
+    def __init__(self, path: Optional[str], run_id: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._file = None
+        self.records: List[Dict] = []
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int, latency: float,
+               stage: Optional[str] = None):
+        entry = {
+            "run_id": self.run_id,
+            "time": time.time(),
+            "stage": stage or current_stage(),
+            "db_id": _current_db_id.get(),
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": round(latency, 4),
+            "cost": estimate_cost(model, prompt_tokens, completion_tokens),
+        }
+        with self._lock:
+            self.records.append(entry)
+            if self.path:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self._file = open(self.path, "a", buffering=1)
+                self._file.write(json.dumps(entry) + "\n")
+
+    def format_report(self) -> str:
+        with self._lock:
+            records = list(self.records)
+        return format_usage_report(records)
+
+
+def _summarize(records: Iterable[Dict], key: str) -> Dict[str, Dict]:
+    groups: Dict[str, Dict] = {}
+    for entry in records:
+        group = groups.setdefault(entry[key] or "-", {
+            "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "latencies": []})
+        group["calls"] += 1
+        group["prompt_tokens"] += entry["prompt_tokens"]
+        group["completion_tokens"] += entry["completion_tokens"]
+        group["cost"] += entry["cost"]
+        group["latencies"].append(entry["latency"])
+    return groups
+
+
+def format_usage_report(records: List[Dict]) -> str:
+    """Tokens, latency and estimated cost per stage and per database."""
+    if not records:
+        return "LLM usage: no calls"
+    lines = []
+    for key, title in [("stage", "stage"), ("db_id", "database")]:
+        lines.append(f"{title:<28}{'calls':>7}{'prompt tok':>12}{'compl tok':>11}{'p50 s':>8}{'p95 s':>8}{'cost $':>10}")
+        groups = _summarize(records, key)
+        order: List[Tuple[str, Dict]] = sorted(groups.items(), key=lambda item: -item[1]["cost"])
+        for name, group in order:
+            lines.append(f"{name:<28}{group['calls']:>7}{group['prompt_tokens']:>12}{group['completion_tokens']:>11}"
+                         f"{percentile(group['latencies'], 0.5):>8.2f}{percentile(group['latencies'], 0.95):>8.2f}"
+                         f"{group['cost']:>10.4f}")
+        lines.append("")
+    total = _summarize(records, "run_id")
+    lines.append("total: " + ", ".join(
+        f"{group['calls']} calls, {group['prompt_tokens']} prompt + {group['completion_tokens']} completion tokens, "
+        f"${group['cost']:.4f}" for group in total.values()))
+    return "\n".join(lines)
+
+
+def read_metrics_file(path: str, run_id: Optional[str] = None) -> List[Dict]:
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [entry for entry in records if run_id is None or entry["run_id"] == run_id]
+
+
+USAGE_METRICS = UsageMetrics(os.getenv("DFIN_METRICS_PATH", "output/metrics/llm_calls.jsonl") or None)
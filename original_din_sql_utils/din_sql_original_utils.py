@@ -4,9 +4,6 @@ import os
 import re
 from typing import List, Tuple
 
-import pandas as pd
-from langchain.utilities.sql_database import SQLDatabase
-
 
 def get_database_schema(DB_URI: str) -> str:
     """Get the database schema from the database URI
@@ -17,6 +14,8 @@ def get_database_schema(DB_URI: str) -> str:
     Returns:
         str: Database schema
     """
+    from langchain.utilities.sql_database import SQLDatabase
+
     db = SQLDatabase.from_uri("sqlite:/// " +DB_URI)
     db._sample_rows_in_table_info = 3
     return db.get_table_info_no_throw()
@@ -71,6 +70,8 @@ def update_json_file(json_filename, index, sql_query, db_id):
         json.dump(data, json_file, indent=4)
 
 def table_descriptions_parser(database_dir):
+    import pandas as pd
+
     csv_files = glob.glob(f"{database_dir}/*.csv")
     # Iterate over the CSV files
     db_descriptions = ""